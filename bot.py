@@ -1,12 +1,18 @@
 import asyncio
+import contextlib
 import logging
 import os
+import re
 import psycopg2
+from collections import OrderedDict
+from dataclasses import dataclass
+from psycopg2 import pool
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional, cast, Tuple, List
+from typing import Dict, Any, Optional, cast, Tuple, List, Iterator
 from telegram import ChatPermissions, Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, Message, Chat, User
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from dotenv import load_dotenv
 import telegram
 print(f"=== TELEGRAM LIBRARY VERSION: {telegram.__version__} ===")
@@ -32,32 +38,151 @@ if not DATABASE_URL:
     logger.error("DATABASE_URL not found in environment variables")
     exit(1)
 
+# Версия схемы БД: если DB_SCHEMA_VERSION в окружении совпадает, инициализация схемы при старте пропускается
+# (проверяется только наличие столбцов настроек, см. DatabaseManager.ensure_settings_columns)
+SCHEMA_VERSION = 1
+
+# Стандартное приветствие (совпадает с DEFAULT столбца chat_settings.welcome_message)
+DEFAULT_WELCOME_MESSAGE = '👋 Добро пожаловать, {mention}! Рады видеть вас в {chat}!'
+
 class CaptchaPolicy:
     PERSISTENT = "persistent"      # ✅ Рекомендуется
     TIME_BASED = "time_based"      # 🔄 Для строгих чатов
     ALWAYS = "always"              # 🚫 Макс. безопасность
 
+# Ключ состояния ввода приветствия в context.user_data
+WELCOME_EDIT_KEY = '_welcome_edit'
+
+@dataclass(slots=True)
+class WelcomeEditState:
+    """Ожидание нового текста приветствия от администратора"""
+    settings_message_id: Optional[int]
+
 class DatabaseManager:
-    def __init__(self, connection_string: str):
+    # Размер пула соединений с PostgreSQL
+    POOL_MIN_CONN = 2
+    POOL_MAX_CONN = 10
+    # Максимальное число чатов в кэше настроек
+    SETTINGS_CACHE_SIZE = 10_000
+    # Столбцы chat_settings, которые можно менять точечно (имя подставляется в SQL)
+    TOGGLE_FIELDS = frozenset({
+        'enabled', 'restrict_new_users', 'delete_service_messages', 'anti_flood_enabled',
+        'protect_comments', 'message_cooldown_enabled', 'captcha_enabled'
+    })
+    SETTABLE_FIELDS = TOGGLE_FIELDS | frozenset({
+        'welcome_message', 'min_account_age_days', 'max_warnings', 'captcha_policy', 'captcha_valid_days'
+    })
+    # Столбцы настроек, читаемые из chat_settings (created_at боту не нужен)
+    SETTINGS_COLUMNS: Tuple[str, ...] = (
+        'chat_id', 'welcome_message', 'min_account_age_days', 'min_join_date_days',
+        'restrict_new_users', 'delete_service_messages', 'enabled', 'max_warnings',
+        'anti_flood_enabled', 'protect_comments', 'message_cooldown_enabled',
+        'captcha_enabled', 'captcha_type', 'captcha_timeout_minutes', 'captcha_max_attempts',
+        'captcha_policy', 'captcha_valid_days'
+    )
+    SETTINGS_SELECT = ', '.join(SETTINGS_COLUMNS)
+
+    def __init__(self, connection_string: str, force_schema: bool = False):
         self.conn_string = connection_string
-        self.init_db()
-        self.recreate_table_properly()
-        self.update_database_schema()
-        self.check_table_structure()
+        # LRU-кэш настроек чатов: chat_id -> настройки (бот единственный, кто их меняет)
+        self._cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        # Чаты с выключенным ботом: обработчики отбрасывают их обновления без обращения к БД
+        self.disabled_chats: set = set()
+        # Пул соединений: handshake с PostgreSQL выполняется один раз, а не на каждый запрос.
+        # Сами запросы остаются синхронными и выполняются в потоке event loop, то есть на время
+        # запроса блокируют остальные обработчики; горячие чтения настроек закрывает _cache.
+        # TCP keepalive не дает простаивающим соединениям молча обрываться на NAT и файрволах
+        self.pool = pool.ThreadedConnectionPool(
+            self.POOL_MIN_CONN, self.POOL_MAX_CONN, self.conn_string,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=5
+        )
+        if force_schema or os.getenv('DB_SCHEMA_VERSION') != str(SCHEMA_VERSION):
+            self.init_db(force=force_schema)
+            self.recreate_table_properly()
+            self.update_database_schema()
+            self.check_table_structure()
+        else:
+            self.ensure_settings_columns()
+        self.load_disabled_chats()
 
-    def get_connection(self) -> psycopg2.extensions.connection:
-        """Создание подключения к PostgreSQL"""
+    @contextlib.contextmanager
+    def get_connection(self) -> Iterator[psycopg2.extensions.connection]:
+        """Подключение к PostgreSQL из пула (транзакция фиксируется при выходе из блока)
+
+        Вызов синхронный: из async-обработчиков он блокирует event loop на время запроса.
+        """
         try:
-            return psycopg2.connect(self.conn_string)
+            conn = self.pool.getconn()
         except Exception as e:
             logger.error(f"Database connection error: {e}")
             raise
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.pool.putconn(conn)
+
+    def missing_settings_columns(self) -> List[str]:
+        """Столбцы SETTINGS_COLUMNS, которых нет в chat_settings (один запрос к information_schema)"""
+        with self.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                    SELECT column_name
+                    FROM information_schema.columns
+                    WHERE table_name = 'chat_settings' AND column_name = ANY(%s)
+                ''', (list(self.SETTINGS_COLUMNS),))
+                present = {row[0] for row in cursor.fetchall()}
+        return [column for column in self.SETTINGS_COLUMNS if column not in present]
+
+    def ensure_settings_columns(self) -> None:
+        """Проверка столбцов настроек, когда инициализация пропущена по DB_SCHEMA_VERSION
+
+        DDL не выполняется, но SELECT настроек перечисляет столбцы явно: без любого из них
+        get_chat_settings всегда возвращал бы None. Недостающие столбцы добавляются,
+        а если схему восстановить не удалось, запуск прерывается.
+        """
+        missing = self.missing_settings_columns()
+        if not missing:
+            logger.info(f"Схема БД версии {SCHEMA_VERSION} уже применена, инициализация пропущена")
+            return
+        logger.warning(f"DB_SCHEMA_VERSION={SCHEMA_VERSION}, но в chat_settings нет столбцов {missing}: обновление схемы")
+        self.init_db()
+        self.update_database_schema()
+        missing = self.missing_settings_columns()
+        if missing:
+            raise RuntimeError(f"В chat_settings нет столбцов {missing}, выполните миграцию схемы")
 
-    def init_db(self) -> None:
+    def load_disabled_chats(self) -> None:
+        """Загрузка списка чатов, в которых бот выключен"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT chat_id FROM chat_settings WHERE enabled = FALSE')
+                    self.disabled_chats = {row[0] for row in cursor.fetchall()}
+            logger.info(f"Бот выключен в {len(self.disabled_chats)} чатах")
+        except Exception as e:
+            logger.error(f"Error loading disabled chats: {e}")
+
+    def init_db(self, force: bool = False) -> None:
         """Инициализация таблиц в PostgreSQL"""
         try:
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
+                    if not force:
+                        # Быстрый путь: все объекты уже есть, DDL (и его блокировки) не нужен
+                        cursor.execute('''
+                            SELECT to_regclass('public.chat_settings') IS NOT NULL
+                               AND to_regclass('public.statistics') IS NOT NULL
+                               AND to_regclass('public.user_warnings') IS NOT NULL
+                               AND to_regclass('public.flood_control') IS NOT NULL
+                               AND to_regclass('public.message_cooldown') IS NOT NULL
+                               AND to_regclass('public.user_captcha') IS NOT NULL
+                               AND to_regclass('public.chat_stats_7d') IS NOT NULL
+                        ''')
+                        if cursor.fetchone() == (True,):
+                            logger.info("Database already initialized")
+                            return
+
                     # Таблица настроек чатов
                     cursor.execute('''
                         CREATE TABLE IF NOT EXISTS chat_settings (
@@ -157,78 +282,145 @@ class DatabaseManager:
                     cursor.execute('CREATE INDEX IF NOT EXISTS idx_flood_control_timestamp ON flood_control(last_message)')
                     cursor.execute('CREATE INDEX IF NOT EXISTS idx_captcha_chat_user ON user_captcha(chat_id, user_id)')
                     cursor.execute('CREATE INDEX IF NOT EXISTS idx_captcha_expires ON user_captcha(expires_at)')
+                    
+                    # Агрегаты действий за 7 дней (обновляются по расписанию)
+                    cursor.execute('''
+                        CREATE MATERIALIZED VIEW IF NOT EXISTS chat_stats_7d AS
+                        SELECT chat_id, action_type, COUNT(*) AS count
+                        FROM statistics
+                        WHERE timestamp >= CURRENT_TIMESTAMP - INTERVAL '7 days'
+                        GROUP BY chat_id, action_type
+                    ''')
+                    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_stats_7d ON chat_stats_7d(chat_id, action_type)')
                 
-                    conn.commit()
                     logger.info("Database initialized successfully")
         except Exception as e:
             logger.error(f"Database initialization error: {e}")
             raise
 
+    def _cache_settings(self, settings: Dict[str, Any]) -> None:
+        """Запись настроек в кэш с вытеснением самых старых"""
+        chat_id = settings['chat_id']
+        self._cache[chat_id] = dict(settings)
+        self._cache.move_to_end(chat_id)
+        if settings.get('enabled', True):
+            self.disabled_chats.discard(chat_id)
+        else:
+            self.disabled_chats.add(chat_id)
+        if len(self._cache) > self.SETTINGS_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def _row_to_settings(self, cursor: Any, result: Tuple) -> Dict[str, Any]:
+        """Преобразование строки chat_settings в словарь настроек"""
+        # psycopg2 уже возвращает int/bool/str, поэтому строка раскладывается по именам столбцов без приведений
+        columns = [desc[0] for desc in cursor.description]
+        return dict(zip(columns, result))
+
     def get_chat_settings(self, chat_id: int) -> Optional[Dict[str, Any]]:
         """Получение настроек чата"""
+        cached = self._cache.get(chat_id)
+        if cached is not None:
+            self._cache.move_to_end(chat_id)
+            # Копия: вызывающий код меняет словарь перед save_chat_settings
+            return cached.copy()
+
         try:
             logger.info(f"Загрузка настроек для чата {chat_id}")
 
             with self.get_connection() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute(
-                        'SELECT * FROM chat_settings WHERE chat_id = %s',
+                        f'SELECT {self.SETTINGS_SELECT} FROM chat_settings WHERE chat_id = %s',
                         (chat_id,)
                     )
                     result = cursor.fetchone()
 
-                    if result:
-                        # Универсальная обработка с проверкой наличия столбцов
-                        columns = [desc[0] for desc in cursor.description]
-                        settings = {
-                            'chat_id': result[columns.index('chat_id')],
-                            'welcome_message': str(result[columns.index('welcome_message')]),
-                            'min_account_age_days': int(result[columns.index('min_account_age_days')]),
-                            'min_join_date_days': int(result[columns.index('min_join_date_days')]),
-                            'restrict_new_users': bool(result[columns.index('restrict_new_users')]),
-                            'delete_service_messages': bool(result[columns.index('delete_service_messages')]),
-                            'enabled': bool(result[columns.index('enabled')]),
-                            'max_warnings': int(result[columns.index('max_warnings')]),
-                            'anti_flood_enabled': bool(result[columns.index('anti_flood_enabled')]),
-                            'protect_comments': bool(result[columns.index('protect_comments')]) if 'protect_comments' in columns else True,
-                            'message_cooldown_enabled': bool(result[columns.index('message_cooldown_enabled')]) if 'message_cooldown_enabled' in columns else False,
-                            'captcha_enabled': bool(result[columns.index('captcha_enabled')]) if 'captcha_enabled' in columns else False,
-                            'captcha_type': str(result[columns.index('captcha_type')]) if 'captcha_type' in columns else 'button',
-                            'captcha_timeout_minutes': int(result[columns.index('captcha_timeout_minutes')]) if 'captcha_timeout_minutes' in columns else 10,
-                            'captcha_max_attempts': int(result[columns.index('captcha_max_attempts')]) if 'captcha_max_attempts' in columns else 3,
-                            'captcha_policy': str(result[columns.index('captcha_policy')]) if 'captcha_policy' in columns else 'persistent',
-                            'captcha_valid_days': int(result[columns.index('captcha_valid_days')]) if 'captcha_valid_days' in columns else 30
-                        }
+                    if not result:
+                        # Новый чат: значения по умолчанию берутся из DEFAULT столбцов
+                        cursor.execute(f'''
+                            INSERT INTO chat_settings (chat_id) VALUES (%s)
+                            ON CONFLICT (chat_id) DO UPDATE SET chat_id = EXCLUDED.chat_id
+                            RETURNING {self.SETTINGS_SELECT}
+                        ''', (chat_id,))
+                        result = cursor.fetchone()
 
-                        logger.info(f"Загруженные настройки captcha_enabled: {settings.get('captcha_enabled')}")
-                        return settings
-                    else:
-                        # Создаем настройки по умолчанию
-                        default_settings = {
-                            'chat_id': chat_id,
-                            'welcome_message': '👋 Добро пожаловать, {mention}! Рады видеть вас в {chat}!',
-                            'min_account_age_days': 1,
-                            'min_join_date_days': 0,
-                            'restrict_new_users': True,
-                            'delete_service_messages': True,
-                            'enabled': True,
-                            'max_warnings': 3,
-                            'anti_flood_enabled': True,
-                            'protect_comments': True,
-                            'message_cooldown_enabled': False,
-                            'captcha_enabled': True,
-                            'captcha_type': 'button',
-                            'captcha_timeout_minutes': 10,
-                            'captcha_max_attempts': 3,
-                            'captcha_policy': 'persistent',
-                            'captcha_valid_days': 30
-                        }
-                        self.save_chat_settings(default_settings)
-                        return default_settings
+                    settings = self._row_to_settings(cursor, result)
+
+            logger.info(f"Загруженные настройки captcha_enabled: {settings.get('captcha_enabled')}")
+            self._cache_settings(settings)
+            return settings
         except Exception as e:
             logger.error(f"Error getting chat settings: {e}")
             return None
 
+    def get_chat_settings_many(self, chat_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Получение настроек нескольких чатов одним запросом
+
+        Чаты без записи в chat_settings в результат не попадают.
+        """
+        result: Dict[int, Dict[str, Any]] = {}
+        missing = []
+        for chat_id in chat_ids:
+            cached = self._cache.get(chat_id)
+            if cached is not None:
+                self._cache.move_to_end(chat_id)
+                result[chat_id] = cached.copy()
+            else:
+                missing.append(chat_id)
+
+        if not missing:
+            return result
+
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        f'SELECT {self.SETTINGS_SELECT} FROM chat_settings WHERE chat_id = ANY(%s)',
+                        (missing,)
+                    )
+                    rows = cursor.fetchall()
+                    for row in rows:
+                        settings = self._row_to_settings(cursor, row)
+                        self._cache_settings(settings)
+                        result[settings['chat_id']] = settings
+        except Exception as e:
+            logger.error(f"Error getting settings for chats {missing}: {e}")
+
+        return result
+
+    def toggle_field(self, chat_id: int, field: str) -> Optional[Dict[str, Any]]:
+        """Инвертирование логической настройки одним UPDATE ... RETURNING"""
+        if field not in self.TOGGLE_FIELDS:
+            raise ValueError(f"Unsupported toggle field: {field}")
+        return self._update_settings(
+            chat_id, f'UPDATE chat_settings SET {field} = NOT {field} WHERE chat_id = %s RETURNING {self.SETTINGS_SELECT}', (chat_id,)
+        )
+
+    def set_field(self, chat_id: int, field: str, value: Any) -> Optional[Dict[str, Any]]:
+        """Установка одной настройки одним UPDATE ... RETURNING"""
+        if field not in self.SETTABLE_FIELDS:
+            raise ValueError(f"Unsupported settings field: {field}")
+        return self._update_settings(
+            chat_id, f'UPDATE chat_settings SET {field} = %s WHERE chat_id = %s RETURNING {self.SETTINGS_SELECT}', (value, chat_id)
+        )
+
+    def _update_settings(self, chat_id: int, query: str, params: Tuple) -> Optional[Dict[str, Any]]:
+        """Выполнение точечного UPDATE настроек и обновление кэша из RETURNING"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, params)
+                    result = cursor.fetchone()
+                    if not result:
+                        logger.warning(f"Настройки для чата {chat_id} не найдены")
+                        return None
+                    settings = self._row_to_settings(cursor, result)
+            self._cache_settings(settings)
+            return settings
+        except Exception as e:
+            logger.error(f"Error updating chat settings: {e}")
+            return None
+
     def save_chat_settings(self, settings: Dict[str, Any]) -> None:
         """Сохранение настроек чата"""
         try:
@@ -280,8 +472,8 @@ class DatabaseManager:
                         settings.get('captcha_policy', 'persistent'),  # НОВОЕ ПОЛЕ
                         settings.get('captcha_valid_days', 30)  # НОВОЕ ПОЛЕ
                     ))
-                    conn.commit()
                     logger.info("Настройки успешно сохранены в БД")
+            self._cache_settings(settings)
         except Exception as e:
             logger.error(f"Error saving chat settings: {e}")
             raise
@@ -296,7 +488,6 @@ class DatabaseManager:
                             'INSERT INTO statistics (chat_id, user_id, action_type, details) VALUES (%s, %s, %s, %s)',
                             (chat_id, user_id, action_type, details)
                         )
-                        conn.commit()
             except Exception as e:
                 logger.error(f"Error logging action: {e}")
 
@@ -389,6 +580,29 @@ class DatabaseManager:
                 'total_actions': 0
             }
         
+    def get_weekly_action_counts(self, chat_id: int) -> Dict[str, int]:
+        """Количество действий за 7 дней из представления chat_stats_7d"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT action_type, count FROM chat_stats_7d WHERE chat_id = %s',
+                        (chat_id,)
+                    )
+                    return {row[0]: row[1] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Error getting weekly action counts: {e}")
+            return {}
+
+    def refresh_weekly_stats(self) -> None:
+        """Обновление представления chat_stats_7d"""
+        try:
+            with self.get_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY chat_stats_7d')
+        except Exception as e:
+            logger.error(f"Error refreshing weekly stats: {e}")
+        
     def get_detailed_statistics(self, chat_id: int) -> Dict[str, Any]:
             """Получение детальной статистики"""
             try:
@@ -470,7 +684,6 @@ class DatabaseManager:
                         RETURNING warnings_count
                     ''', (chat_id, user_id))
                     result = cursor.fetchone()
-                    conn.commit()
                     return result[0] if result else 1
         except Exception as e:
             logger.error(f"Error adding user warning: {e}")
@@ -500,7 +713,6 @@ class DatabaseManager:
                         'DELETE FROM user_warnings WHERE chat_id = %s AND user_id = %s',
                         (chat_id, user_id)
                     )
-                    conn.commit()
         except Exception as e:
             logger.error(f"Error resetting user warnings: {e}")
 
@@ -511,7 +723,6 @@ class DatabaseManager:
                 with conn.cursor() as cursor:
                     cursor.execute('DELETE FROM statistics WHERE chat_id = %s', (chat_id,))
                     cursor.execute('DELETE FROM user_warnings WHERE chat_id = %s', (chat_id,))
-                    conn.commit()
         except Exception as e:
             logger.error(f"Error resetting statistics: {e}")
 
@@ -548,7 +759,6 @@ class DatabaseManager:
                             VALUES (%s, %s, %s)
                         ''', (chat_id, user_id, message_count))
                     
-                    conn.commit()
                     return message_count > max_messages
                     
         except Exception as e:
@@ -564,7 +774,6 @@ class DatabaseManager:
                         'DELETE FROM flood_control WHERE chat_id = %s AND user_id = %s',
                         (chat_id, user_id)
                     )
-                    conn.commit()
         except Exception as e:
             logger.error(f"Error resetting flood control: {e}")
     
@@ -596,7 +805,6 @@ class DatabaseManager:
                             cursor.execute(f'ALTER TABLE chat_settings ADD COLUMN {column_name} {column_type}')
                             logger.info(f"Added {column_name} column to chat_settings table")
 
-                    conn.commit()
         except Exception as e:
             logger.error(f"Error updating database schema: {e}")
     
@@ -702,7 +910,6 @@ class DatabaseManager:
                     # Переименовываем временную таблицу
                     cursor.execute('ALTER TABLE chat_settings_temp RENAME TO chat_settings')
 
-                    conn.commit()
                     logger.info("Таблица chat_settings пересоздана с правильной структурой")
 
         except Exception as e:
@@ -746,7 +953,6 @@ class DatabaseManager:
                         last_message = CURRENT_TIMESTAMP
                     ''', (chat_id, user_id))
                     
-                    conn.commit()
                     return True, 0
                     
         except Exception as e:
@@ -762,7 +968,6 @@ class DatabaseManager:
                         'DELETE FROM message_cooldown WHERE chat_id = %s AND user_id = %s',
                         (chat_id, user_id)
                     )
-                    conn.commit()
         except Exception as e:
             logger.error(f"Error resetting user cooldown: {e}")
     
@@ -780,7 +985,6 @@ class DatabaseManager:
                         attempts = 0,
                         expires_at = EXCLUDED.expires_at
                     ''', (chat_id, user_id, message_id))
-                    conn.commit()
                     return True
         except Exception as e:
             logger.error(f"Error creating captcha: {e}")
@@ -815,7 +1019,6 @@ class DatabaseManager:
                         SET captcha_passed = TRUE 
                         WHERE chat_id = %s AND user_id = %s
                     ''', (chat_id, user_id))
-                    conn.commit()
                     return cursor.rowcount > 0
         except Exception as e:
             logger.error(f"Error marking captcha passed: {e}")
@@ -834,7 +1037,6 @@ class DatabaseManager:
                     ''', (chat_id, user_id))
 
                     result = cursor.fetchone()
-                    conn.commit()
 
                     if result:
                         attempts, max_attempts = result
@@ -853,7 +1055,6 @@ class DatabaseManager:
                         DELETE FROM user_captcha 
                         WHERE chat_id = %s AND user_id = %s
                     ''', (chat_id, user_id))
-                    conn.commit()
                     return True
         except Exception as e:
             logger.error(f"Error deleting captcha: {e}")
@@ -883,6 +1084,171 @@ except Exception as e:
     logger.error(f"Failed to initialize database: {e}")
     exit(1)
                                 
+# Статические клавиатуры меню: не зависят от настроек чата и создаются один раз при импорте
+_MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🛡️ Статус защиты", callback_data="status")],
+    [
+        InlineKeyboardButton("⚙️ Основные настройки", callback_data="main_settings"),
+        InlineKeyboardButton("👋 Приветствия", callback_data="welcome_settings")
+    ],
+    [
+        InlineKeyboardButton("💬 Комментарии", callback_data="comments_settings"),
+        InlineKeyboardButton("⏰ Ограничения", callback_data="cooldown_settings")  # Новая кнопка
+    ],
+    [
+        InlineKeyboardButton("📊 Статистика", callback_data="stats"),
+        InlineKeyboardButton("❓ Помощь", callback_data="help_menu")
+    ],
+    [InlineKeyboardButton("🔧 Быстрые действия", callback_data="quick_actions")]
+])
+
+_STATUS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⚙️ Настроить", callback_data="main_settings")],
+    [InlineKeyboardButton("📊 Статистика", callback_data="stats")],
+    [InlineKeyboardButton("◀️ В главное меню", callback_data="main_menu")]
+])
+
+_WELCOME_SETTINGS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Изменить приветствие", callback_data="set_welcome")],
+    [InlineKeyboardButton("👀 Посмотреть текущее", callback_data="view_welcome")],
+    [InlineKeyboardButton("🔄 Сбросить к стандартному", callback_data="reset_welcome")],
+    [InlineKeyboardButton("🏠 В главное", callback_data="main_menu")]
+])
+
+_QUICK_ACTIONS_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🟢 Включить всё", callback_data="enable_all"),
+        InlineKeyboardButton("🔴 Выключить всё", callback_data="disable_all")
+    ],
+    [
+        InlineKeyboardButton("🛡️ Стандартная защита", callback_data="standard_preset"),
+        InlineKeyboardButton("🚫 Макс. защита", callback_data="max_preset")
+    ],
+    [
+        InlineKeyboardButton("📊 Сброс статистики", callback_data="reset_stats"),
+        InlineKeyboardButton("🔄 Перезагрузить бота", callback_data="reload_bot")
+    ],
+    [InlineKeyboardButton("◀️ В главное меню", callback_data="main_menu")]
+])
+
+_AGE_SETTINGS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("0 дней - разрешить все", callback_data="age_0")],
+    [InlineKeyboardButton("1 день - минимальная", callback_data="age_1")],
+    [InlineKeyboardButton("3 дня - стандартная", callback_data="age_3")],
+    [InlineKeyboardButton("7 дней - строгая", callback_data="age_7")],
+    [InlineKeyboardButton("30 дней - максимальная", callback_data="age_30")],
+    [
+        InlineKeyboardButton("◀️ Назад", callback_data="main_settings"),
+        InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
+    ]
+])
+
+_HELP_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 Команды бота", callback_data="bot_commands")],
+    [InlineKeyboardButton("🛡️ Как настроить защиту", callback_data="setup_guide")],
+    [InlineKeyboardButton("❓ Частые вопросы", callback_data="faq")],
+    [InlineKeyboardButton("📞 Поддержка", callback_data="support")],
+    [
+        InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
+    ]
+])
+
+_STATS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Обновить", callback_data="stats")],
+    [InlineKeyboardButton("📈 Детальная статистика", callback_data="detailed_stats")],
+    [InlineKeyboardButton("🗑️ Сбросить статистику", callback_data="reset_stats_confirm")],
+    [
+        InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
+    ]
+])
+
+_DETAILED_STATS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Основная статистика", callback_data="stats")],
+    [InlineKeyboardButton("🔄 Обновить", callback_data="detailed_stats")],
+    [
+        InlineKeyboardButton("◀️ Назад", callback_data="stats"),
+        InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
+    ]
+])
+
+_RESET_STATS_CONFIRM_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Да, сбросить", callback_data="reset_stats"),
+        InlineKeyboardButton("❌ Отмена", callback_data="stats")
+    ]
+])
+
+_BACK_TO_HELP_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Назад в помощь", callback_data="help_menu")],
+    [InlineKeyboardButton("🏠 В главное меню", callback_data="main_menu")]
+])
+
+_SETUP_GUIDE_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🛡️ Стандартная настройка", callback_data="standard_preset"),
+        InlineKeyboardButton("🚫 Макс. защита", callback_data="max_preset")
+    ],
+    [InlineKeyboardButton("◀️ Назад в помощь", callback_data="help_menu")],
+    [InlineKeyboardButton("🏠 В главное меню", callback_data="main_menu")]
+])
+
+_SUPPORT_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("◀️ Назад в помощь", callback_data="help_menu"),
+        InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
+    ]
+])
+
+_COMMENTS_STATS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Обновить", callback_data="comments_stats")],
+    [InlineKeyboardButton("⚙️ Настройки комментариев", callback_data="comments_settings")],
+    [
+        InlineKeyboardButton("◀️ Назад", callback_data="comments_settings"),
+        InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
+    ]
+])
+
+# Тексты команд /start и /help
+_START_PRIVATE_TEMPLATE = (
+    "👋 <b>Привет, {name}!</b>\n\n"
+    "🛡️ <b>Я - умный бот защиты от спама</b>\n\n"
+    "✨ <b>Мои возможности:</b>\n"
+    "• 🤖 Автоматическая модерация\n"
+    "• ⏱️ Фильтр по возрасту аккаунтов\n"
+    "• 🌊 Защита от флуда\n"
+    "• 👋 Умные приветствия\n"
+    "• ⚠️ Система предупреждений\n"
+    "• 🗑️ Очистка сервисных сообщений\n\n"
+    "🚀 <b>Для начала работы:</b>\n"
+    "1. Добавьте меня в группу\n"
+    "2. Назначьте администратором\n"
+    "3. Настройте через /menu\n\n"
+    "💡 <b>Используйте /menu для удобного управления!</b>"
+)
+
+_START_GROUP_TEXT = (
+    "🛡️ <b>Бот защиты активирован!</b>\n\n"
+    "💫 Используйте /menu для удобной настройки параметров защиты"
+)
+
+_HELP_TEXT = """
+🛡️ <b>Команды бота защиты</b>
+
+🎛️ <b>Основные команды:</b>
+/menu - Главное меню управления
+/settings - Быстрые настройки
+/status - Статус защиты
+/enable - Включить бота
+/disable - Выключить бота
+
+💫 <b>Удобное управление:</b>
+• Используйте /menu для полного контроля
+• Настройте защиту в несколько кликов
+• Просматривайте статистику в реальном времени
+
+🚀 <b>Добавьте бота в группу и назначьте администратором!</b>
+    """
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Команда /start"""
     user = update.effective_user
@@ -894,28 +1260,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         
     if chat.type == 'private':
         await message.reply_text(
-            f"👋 <b>Привет, {user.first_name}!</b>\n\n"
-            "🛡️ <b>Я - умный бот защиты от спама</b>\n\n"
-            "✨ <b>Мои возможности:</b>\n"
-            "• 🤖 Автоматическая модерация\n"
-            "• ⏱️ Фильтр по возрасту аккаунтов\n" 
-            "• 🌊 Защита от флуда\n"
-            "• 👋 Умные приветствия\n"
-            "• ⚠️ Система предупреждений\n"
-            "• 🗑️ Очистка сервисных сообщений\n\n"
-            "🚀 <b>Для начала работы:</b>\n"
-            "1. Добавьте меня в группу\n"
-            "2. Назначьте администратором\n"
-            "3. Настройте через /menu\n\n"
-            "💡 <b>Используйте /menu для удобного управления!</b>",
+            _START_PRIVATE_TEMPLATE.format(name=user.first_name),
             parse_mode=ParseMode.HTML
         )
     else:
-        await message.reply_text(
-            "🛡️ <b>Бот защиты активирован!</b>\n\n"
-            "💫 Используйте /menu для удобной настройки параметров защиты",
-            parse_mode=ParseMode.HTML
-        )
+        await message.reply_text(_START_GROUP_TEXT, parse_mode=ParseMode.HTML)
 
 async def safe_edit_message(
     context: ContextTypes.DEFAULT_TYPE, 
@@ -937,17 +1286,19 @@ async def safe_edit_message(
             parse_mode=ParseMode.HTML
         )
         return True
-    except Exception as e:
-        if "Message is not modified" in str(e):
+    except BadRequest as e:
+        if 'not modified' in str(e).lower():
             # Это не ошибка, просто сообщение не изменилось
             logger.debug(f"Message {message_id} in chat {chat_id} was not modified (same content)")
             return True
-        elif "Message to edit not found" in str(e):
+        if "message to edit not found" in str(e).lower():
             logger.warning(f"Message {message_id} not found in chat {chat_id}")
             return False
-        else:
-            logger.error(f"Error editing message {message_id} in chat {chat_id}: {e}")
-            return False
+        logger.error(f"Error editing message {message_id} in chat {chat_id}: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Error editing message {message_id} in chat {chat_id}: {e}")
+        return False
     
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: Optional[int] = None, message_id: Optional[int] = None) -> None:
     """Главное меню бота - работает с командами и кнопками"""
@@ -1013,24 +1364,7 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: Opti
         return
     
     # Главное меню
-    keyboard = [
-        [InlineKeyboardButton("🛡️ Статус защиты", callback_data="status")],
-        [
-            InlineKeyboardButton("⚙️ Основные настройки", callback_data="main_settings"),
-            InlineKeyboardButton("👋 Приветствия", callback_data="welcome_settings")
-        ],
-        [
-            InlineKeyboardButton("💬 Комментарии", callback_data="comments_settings"),
-            InlineKeyboardButton("⏰ Ограничения", callback_data="cooldown_settings")  # Новая кнопка
-        ],
-        [
-            InlineKeyboardButton("📊 Статистика", callback_data="stats"),
-            InlineKeyboardButton("❓ Помощь", callback_data="help_menu")
-        ],
-        [InlineKeyboardButton("🔧 Быстрые действия", callback_data="quick_actions")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _MAIN_MENU_KB
     
     status_icon = "🟢" if settings_data['enabled'] else "🔴"
     
@@ -1091,13 +1425,7 @@ async def show_status(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_i
     if not settings_data:
         return
     
-    keyboard = [
-        [InlineKeyboardButton("⚙️ Настроить", callback_data="main_settings")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="stats")],
-        [InlineKeyboardButton("◀️ В главное меню", callback_data="main_menu")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _STATUS_KB
     
     # Иконки статусов
     status_icon = "🟢" if settings_data['enabled'] else "🔴"
@@ -1143,9 +1471,36 @@ async def show_status(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_i
             parse_mode=ParseMode.HTML
         )
 
-async def show_main_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
+# Шаблон экрана основных настроек (форматируется через str.format)
+_MAIN_SETTINGS_TMPL = (
+    "⚙️ <b>Основные настройки</b>\n\n"
+    "<b>Текущие параметры:</b>\n"
+    "• Статус бота: <b>{status}</b>\n"
+    "• Мин. возраст аккаунта: <b>{age} дн.</b>\n"
+    "• Удаление сообщений: <b>{service}</b>\n"
+    "• Анти-флуд: <b>{flood}</b>\n"
+    "• Капча для новых: <b>{captcha}</b>\n"
+    "• Макс. предупреждений: <b>{warnings}</b>\n\n"
+    
+    "💡 <i>Выберите параметр для изменения</i>"
+)
+
+# Последний отрисованный текст основных настроек: (chat_id, message_id) -> текст
+_LAST_RENDER_SIZE = 10_000
+_last_render: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+
+def _remember_render(key: Tuple[int, int], text: str) -> None:
+    """Запоминание отрисованного текста с вытеснением самых старых записей"""
+    _last_render[key] = text
+    _last_render.move_to_end(key)
+    if len(_last_render) > _LAST_RENDER_SIZE:
+        _last_render.popitem(last=False)
+
+async def show_main_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None,
+        settings_data: Optional[Dict[str, Any]] = None) -> None:
     """Основные настройки"""
-    settings_data = db.get_chat_settings(chat_id)
+    if settings_data is None:
+        settings_data = db.get_chat_settings(chat_id)
     if not settings_data:
         return
     
@@ -1174,26 +1529,26 @@ async def show_main_settings(update: Update, context: ContextTypes.DEFAULT_TYPE,
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    # Добавляем временную метку чтобы сообщение всегда было уникальным
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    
-    text = (
-        f"⚙️ <b>Основные настройки</b>\n\n"
-        f"<b>Текущие параметры:</b>\n"
-        f"• Статус бота: <b>{'ВКЛЮЧЕН' if settings_data['enabled'] else 'ВЫКЛЮЧЕН'}</b>\n"
-        f"• Мин. возраст аккаунта: <b>{settings_data['min_account_age_days']} дн.</b>\n"
-        f"• Удаление сообщений: <b>{'ВКЛ' if settings_data['delete_service_messages'] else 'ВЫКЛ'}</b>\n"
-        f"• Анти-флуд: <b>{'ВКЛ' if settings_data['anti_flood_enabled'] else 'ВЫКЛ'}</b>\n"
-        f"• Капча для новых: <b>{'ВКЛ' if settings_data.get('captcha_enabled', False) else 'ВЫКЛ'}</b>\n"
-        f"• Макс. предупреждений: <b>{settings_data['max_warnings']}</b>\n\n"
-        
-        f"💡 <i>Выберите параметр для изменения</i>\n"
-        f"<i>Обновлено: {timestamp}</i>"
+    text = _MAIN_SETTINGS_TMPL.format(
+        status='ВКЛЮЧЕН' if settings_data['enabled'] else 'ВЫКЛЮЧЕН',
+        age=settings_data['min_account_age_days'],
+        service='ВКЛ' if settings_data['delete_service_messages'] else 'ВЫКЛ',
+        flood='ВКЛ' if settings_data['anti_flood_enabled'] else 'ВЫКЛ',
+        captcha='ВКЛ' if settings_data.get('captcha_enabled', False) else 'ВЫКЛ',
+        warnings=settings_data['max_warnings']
     )
     
     if message_id:
+        render_key = (chat_id, message_id)
+        query = update.callback_query if update else None
+        # Сообщение всё ещё показывает этот экран с тем же текстом - Telegram ответил бы "message is not modified"
+        if (query and query.message and query.message.reply_markup == reply_markup
+                and _last_render.get(render_key) == text):
+            return
         success = await safe_edit_message(context, chat_id, message_id, text, reply_markup)
-        if not success:
+        if success:
+            _remember_render(render_key, text)
+        else:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text=text,
@@ -1208,20 +1563,15 @@ async def show_main_settings(update: Update, context: ContextTypes.DEFAULT_TYPE,
             parse_mode=ParseMode.HTML
         )
 
-async def show_welcome_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
+async def show_welcome_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None,
+        settings_data: Optional[Dict[str, Any]] = None) -> None:
     """Настройки приветствий"""
-    settings_data = db.get_chat_settings(chat_id)
+    if settings_data is None:
+        settings_data = db.get_chat_settings(chat_id)
     if not settings_data:
         return
     
-    keyboard = [
-        [InlineKeyboardButton("✏️ Изменить приветствие", callback_data="set_welcome")],
-        [InlineKeyboardButton("👀 Посмотреть текущее", callback_data="view_welcome")],
-        [InlineKeyboardButton("🔄 Сбросить к стандартному", callback_data="reset_welcome")],
-        [InlineKeyboardButton("🏠 В главное", callback_data="main_menu")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _WELCOME_SETTINGS_KB
     
     welcome_preview = settings_data['welcome_message'][:100] + "..." if len(settings_data['welcome_message']) > 100 else settings_data['welcome_message']
     
@@ -1261,23 +1611,7 @@ async def show_quick_actions(update: Update, context: ContextTypes.DEFAULT_TYPE,
     if not settings_data:
         return
     
-    keyboard = [
-        [
-            InlineKeyboardButton("🟢 Включить всё", callback_data="enable_all"),
-            InlineKeyboardButton("🔴 Выключить всё", callback_data="disable_all")
-        ],
-        [
-            InlineKeyboardButton("🛡️ Стандартная защита", callback_data="standard_preset"),
-            InlineKeyboardButton("🚫 Макс. защита", callback_data="max_preset")
-        ],
-        [
-            InlineKeyboardButton("📊 Сброс статистики", callback_data="reset_stats"),
-            InlineKeyboardButton("🔄 Перезагрузить бота", callback_data="reload_bot")
-        ],
-        [InlineKeyboardButton("◀️ В главное меню", callback_data="main_menu")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _QUICK_ACTIONS_KB
     
     text = (
         f"🔧 <b>Быстрые действия</b>\n\n"
@@ -1309,25 +1643,15 @@ async def show_quick_actions(update: Update, context: ContextTypes.DEFAULT_TYPE,
             parse_mode=ParseMode.HTML
         )
 
-async def show_age_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
+async def show_age_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None,
+        settings_data: Optional[Dict[str, Any]] = None) -> None:
     """Настройки возраста аккаунта"""
-    settings_data = db.get_chat_settings(chat_id)
+    if settings_data is None:
+        settings_data = db.get_chat_settings(chat_id)
     if not settings_data:
         return
     
-    keyboard = [
-        [InlineKeyboardButton("0 дней - разрешить все", callback_data="age_0")],
-        [InlineKeyboardButton("1 день - минимальная", callback_data="age_1")],
-        [InlineKeyboardButton("3 дня - стандартная", callback_data="age_3")],
-        [InlineKeyboardButton("7 дней - строгая", callback_data="age_7")],
-        [InlineKeyboardButton("30 дней - максимальная", callback_data="age_30")],
-        [
-            InlineKeyboardButton("◀️ Назад", callback_data="main_settings"),
-            InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _AGE_SETTINGS_KB
     
     current_age = settings_data['min_account_age_days']
     age_description = {
@@ -1367,9 +1691,11 @@ async def show_age_settings(update: Update, context: ContextTypes.DEFAULT_TYPE,
             parse_mode=ParseMode.HTML
         )
 
-async def show_warnings_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
+async def show_warnings_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None,
+        settings_data: Optional[Dict[str, Any]] = None) -> None:
     """Настройки предупреждений"""
-    settings_data = db.get_chat_settings(chat_id)
+    if settings_data is None:
+        settings_data = db.get_chat_settings(chat_id)
     if not settings_data:
         return
     
@@ -1419,17 +1745,7 @@ async def show_warnings_settings(update: Update, context: ContextTypes.DEFAULT_T
 
 async def show_help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
     """Меню помощи"""
-    keyboard = [
-        [InlineKeyboardButton("📚 Команды бота", callback_data="bot_commands")],
-        [InlineKeyboardButton("🛡️ Как настроить защиту", callback_data="setup_guide")],
-        [InlineKeyboardButton("❓ Частые вопросы", callback_data="faq")],
-        [InlineKeyboardButton("📞 Поддержка", callback_data="support")],
-        [
-            InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _HELP_MENU_KB
     
     text = (
         f"❓ <b>Помощь и поддержка</b>\n\n"
@@ -1472,16 +1788,7 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id
         except Exception:
             top_users_info.append(f"• User {user_id}: {count} действий")
     
-    keyboard = [
-        [InlineKeyboardButton("🔄 Обновить", callback_data="stats")],
-        [InlineKeyboardButton("📈 Детальная статистика", callback_data="detailed_stats")],
-        [InlineKeyboardButton("🗑️ Сбросить статистику", callback_data="reset_stats_confirm")],
-        [
-            InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _STATS_KB
     
     # Форматируем статистику
     actions: Dict[str, int] = stats_data.get('actions', {})
@@ -1531,16 +1838,7 @@ async def show_detailed_stats(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Показать детальную статистику"""
     detailed_stats: Dict[str, Any] = db.get_detailed_statistics(chat_id)
     
-    keyboard = [
-        [InlineKeyboardButton("📊 Основная статистика", callback_data="stats")],
-        [InlineKeyboardButton("🔄 Обновить", callback_data="detailed_stats")],
-        [
-            InlineKeyboardButton("◀️ Назад", callback_data="stats"),
-            InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _DETAILED_STATS_KB
     
     # Форматируем детальную статистику
     all_time_text = ""
@@ -1601,14 +1899,7 @@ async def show_detailed_stats(update: Update, context: ContextTypes.DEFAULT_TYPE
         
 async def show_reset_stats_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
     """Подтверждение сброса статистики"""
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Да, сбросить", callback_data="reset_stats"),
-            InlineKeyboardButton("❌ Отмена", callback_data="stats")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _RESET_STATS_CONFIRM_KB
     
     text = (
         f"🗑️ <b>Сброс статистики</b>\n\n"
@@ -1723,7 +2014,6 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             with db.get_connection() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute('DELETE FROM flood_control WHERE chat_id = %s', (chat_id,))
-                    conn.commit()
             await query.answer("✅ Статистика флуда сброшена")
             await show_flood_settings(update, context, chat_id, message_id)
         except Exception as e:
@@ -1733,21 +2023,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await show_cooldown_settings(update, context, chat_id, message_id)
         return
     elif data == "toggle_cooldown":
-        settings_data = db.get_chat_settings(chat_id)
+        settings_data = db.toggle_field(chat_id, 'message_cooldown_enabled')
         if settings_data:
-            current_value = settings_data.get('message_cooldown_enabled', False)
-            settings_data['message_cooldown_enabled'] = not current_value
-            db.save_chat_settings(settings_data)
             status = "включено" if settings_data['message_cooldown_enabled'] else "выключено"
             await query.answer(f"✅ Ограничение сообщений {status}")
-            await show_cooldown_settings(update, context, chat_id, message_id)
+            await show_cooldown_settings(update, context, chat_id, message_id, settings_data=settings_data)
         return
     elif data == "reset_all_cooldowns":
         try:
             with db.get_connection() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute('DELETE FROM message_cooldown WHERE chat_id = %s', (chat_id,))
-                    conn.commit()
             await query.answer("✅ Все ограничения сброшены")
             await show_cooldown_settings(update, context, chat_id, message_id)
         except Exception as e:
@@ -1758,51 +2044,30 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await show_captcha_settings(update, context, chat_id, message_id)
         return
     elif data == "toggle_captcha":
-        settings_data = db.get_chat_settings(chat_id)
-        if settings_data:
-            current_value = settings_data.get('captcha_enabled', False)
-            logger.info(f"Текущее значение captcha_enabled: {current_value}")
-
-            settings_data['captcha_enabled'] = not current_value
-            logger.info(f"Новое значение captcha_enabled: {settings_data['captcha_enabled']}")
-
-            # Принудительно сохраняем все настройки
-            try:
-                db.save_chat_settings(settings_data)
-                logger.info("Настройки успешно сохранены")
-
-                # Проверяем сохранение
-                settings_after_save = db.get_chat_settings(chat_id)
-                if settings_after_save:
-                    logger.info(f"Проверка после сохранения - captcha_enabled: {settings_after_save.get('captcha_enabled')}")
-
-                status = "включена" if settings_data['captcha_enabled'] else "выключена"
-                await query.answer(f"✅ Капча {status}")
-
-                # Добавляем небольшую задержку перед обновлением
-                await asyncio.sleep(0.5)
-                await show_captcha_settings(update, context, chat_id, message_id)
+        settings_data = db.toggle_field(chat_id, 'captcha_enabled')
+        if not settings_data:
+            await query.answer("❌ Ошибка при сохранении настроек", show_alert=True)
+            return
+        logger.info(f"Новое значение captcha_enabled: {settings_data['captcha_enabled']}")
 
-            except Exception as save_error:
-                logger.error(f"Error saving captcha settings: {save_error}")
-                await query.answer("❌ Ошибка при сохранении настроек", show_alert=True)
+        status = "включена" if settings_data['captcha_enabled'] else "выключена"
+        await query.answer(f"✅ Капча {status}")
+        await show_captcha_settings(update, context, chat_id, message_id, settings_data=settings_data)
         return
     elif data == "captcha_policy_settings":
         await show_captcha_policy_settings(update, context, chat_id, message_id)
         return
     elif data.startswith("captcha_policy_"):
         policy = data.split("_")[2]  # persistent, time_based, always
-        settings_data = db.get_chat_settings(chat_id)
+        settings_data = db.set_field(chat_id, 'captcha_policy', policy)
         if settings_data:
-            settings_data['captcha_policy'] = policy
-            db.save_chat_settings(settings_data)
             policy_names = {
                 'persistent': 'Постоянная',
                 'time_based': 'Временная', 
                 'always': 'Всегда'
             }
             await query.answer(f"✅ Установлена политика: {policy_names.get(policy, policy)}")
-            await show_captcha_policy_settings(update, context, chat_id, message_id)
+            await show_captcha_policy_settings(update, context, chat_id, message_id, settings_data=settings_data)
         return
     elif data in ["increase_valid_days", "decrease_valid_days"]:
         settings_data = db.get_chat_settings(chat_id)
@@ -1813,10 +2078,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             else:
                 new_days = max(1, current_days - 1)
 
-            settings_data['captcha_valid_days'] = new_days
-            db.save_chat_settings(settings_data)
+            settings_data = db.set_field(chat_id, 'captcha_valid_days', new_days)
             await query.answer(f"✅ Срок действия: {new_days} дней")
-            await show_captcha_policy_settings(update, context, chat_id, message_id)
+            await show_captcha_policy_settings(update, context, chat_id, message_id, settings_data=settings_data)
         return
     elif data == "reset_all_warnings":
         # Сброс всех предупреждений в чате
@@ -1828,37 +2092,30 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Основные действия
     elif data.startswith("age_"):
         days = int(data.split("_")[1])
-        settings_data = db.get_chat_settings(chat_id)
+        settings_data = db.set_field(chat_id, 'min_account_age_days', days)
         if settings_data:
-            settings_data['min_account_age_days'] = days
-            db.save_chat_settings(settings_data)
             await query.answer(f"✅ Установлен возраст: {days} дней")
-            await show_age_settings(update, context, chat_id, message_id)
+            await show_age_settings(update, context, chat_id, message_id, settings_data=settings_data)
     
     elif data.startswith("toggle_"):
-        settings_data = db.get_chat_settings(chat_id)
+        # Кнопка -> (столбец, формы статуса "вкл"/"выкл")
+        toggles = {
+            "toggle_enable": ('enabled', "включен", "выключен"),
+            "toggle_service": ('delete_service_messages', "включено", "выключено"),
+            "toggle_flood": ('anti_flood_enabled', "включена", "выключена"),
+            "toggle_restrict": ('restrict_new_users', "включены", "выключены"),
+        }
+        if data not in toggles:
+            return
+        field, status_on, status_off = toggles[data]
+        
+        settings_data = db.toggle_field(chat_id, field)
         if not settings_data:
             return
-            
-        # Инициализируем переменную status_text
-        status_text = ""
-        if data == "toggle_enable":
-            settings_data['enabled'] = not settings_data['enabled']
-            status_text = "включен" if settings_data['enabled'] else "выключен"
-        elif data == "toggle_service":
-            settings_data['delete_service_messages'] = not settings_data['delete_service_messages']
-            status_text = "включено" if settings_data['delete_service_messages'] else "выключено"
-        elif data == "toggle_flood":
-            settings_data['anti_flood_enabled'] = not settings_data['anti_flood_enabled']
-            status_text = "включена" if settings_data['anti_flood_enabled'] else "выключена"
-        elif data == "toggle_restrict":
-            settings_data['restrict_new_users'] = not settings_data['restrict_new_users']
-            status_text = "включены" if settings_data['restrict_new_users'] else "выключены"
         
-                
-        db.save_chat_settings(settings_data)
+        status_text = status_on if settings_data[field] else status_off
         await query.answer(f"✅ Тихий режим {status_text}")
-        await show_main_settings(update, context, chat_id, message_id)
+        await show_main_settings(update, context, chat_id, message_id, settings_data=settings_data)
     
     elif data in ["increase_warnings", "decrease_warnings"]:
         settings_data = db.get_chat_settings(chat_id)
@@ -1868,9 +2125,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             else:
                 settings_data['max_warnings'] = max(1, settings_data['max_warnings'] - 1)
                 
-            db.save_chat_settings(settings_data)
-            await query.answer(f"✅ Установлено: {settings_data['max_warnings']} предупреждений")
-            await show_warnings_settings(update, context, chat_id, message_id)
+            settings_data = db.set_field(chat_id, 'max_warnings', settings_data['max_warnings'])
+            if settings_data:
+                await query.answer(f"✅ Установлено: {settings_data['max_warnings']} предупреждений")
+                await show_warnings_settings(update, context, chat_id, message_id, settings_data=settings_data)
+            else:
+                await query.answer("❌ Ошибка при сохранении настроек", show_alert=True)
     
     elif data == "set_welcome":
         await query.edit_message_text(
@@ -1885,8 +2145,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             parse_mode=ParseMode.HTML
         )
         if context.user_data is not None:
-            context.user_data['awaiting_welcome'] = True
-            context.user_data['settings_message_id'] = message_id
+            context.user_data[WELCOME_EDIT_KEY] = WelcomeEditState(settings_message_id=message_id)
     
     elif data == "view_welcome":
         settings_data = db.get_chat_settings(chat_id)
@@ -1894,12 +2153,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await query.answer(f"📝 Текущее приветствие: {settings_data['welcome_message']}", show_alert=True)
     
     elif data == "reset_welcome":
-        settings_data = db.get_chat_settings(chat_id)
+        settings_data = db.set_field(chat_id, 'welcome_message', DEFAULT_WELCOME_MESSAGE)
         if settings_data:
-            settings_data['welcome_message'] = '👋 Добро пожаловать, {mention}! Рады видеть вас в {chat}!'
-            db.save_chat_settings(settings_data)
             await query.answer("✅ Приветствие сброшено к стандартному")
-            await show_welcome_settings(update, context, chat_id, message_id)
+            await show_welcome_settings(update, context, chat_id, message_id, settings_data=settings_data)
     
     elif data == "noop":
         await query.answer()
@@ -1969,28 +2226,24 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not message or not chat or not context.user_data:
         return
         
-    if 'awaiting_welcome' in context.user_data and context.user_data['awaiting_welcome']:
-        chat_id = chat.id
-        welcome_message = message.text
+    state = context.user_data.get(WELCOME_EDIT_KEY)
+    if not isinstance(state, WelcomeEditState):
+        return
         
-        if not welcome_message:
-            return
-            
-        settings_data = db.get_chat_settings(chat_id)
-        if settings_data:
-            settings_data['welcome_message'] = welcome_message
-            db.save_chat_settings(settings_data)
-            
-            del context.user_data['awaiting_welcome']
-            message_id = context.user_data.get('settings_message_id')
-            if 'settings_message_id' in context.user_data:
-                del context.user_data['settings_message_id']
-                
-            await message.reply_text("✅ Приветственное сообщение обновлено!")
-            
-            # Возвращаемся к меню настроек приветствий
-            if message_id:
-                await show_welcome_settings(update, context, chat_id, message_id)
+    chat_id = chat.id
+    welcome_message = message.text
+    
+    if not welcome_message:
+        return
+        
+    settings_data = db.set_field(chat_id, 'welcome_message', welcome_message)
+    if settings_data:
+        del context.user_data[WELCOME_EDIT_KEY]
+        await message.reply_text("✅ Приветственное сообщение обновлено!")
+        
+        # Возвращаемся к меню настроек приветствий
+        if state.settings_message_id:
+            await show_welcome_settings(update, context, chat_id, state.settings_message_id, settings_data=settings_data)
 
 def should_show_captcha(chat_id: int, user_id: int) -> bool:
         """Определяет, нужно ли показывать капчу пользователю"""
@@ -2027,10 +2280,18 @@ async def new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if not chat or not message:
         return
         
+    if chat.id in db.disabled_chats:
+        return
+        
     settings_data = db.get_chat_settings(chat.id)
     if not settings_data or not settings_data['enabled']:
         return
     
+    # Граница возраста аккаунта вычисляется один раз на всё событие
+    now = datetime.now()
+    min_age_days = settings_data['min_account_age_days']
+    cutoff = now - timedelta(days=min_age_days) if min_age_days > 0 else None
+    
     for member in message.new_chat_members:
         if not member:
             continue
@@ -2043,13 +2304,13 @@ async def new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         db.log_action(chat.id, member.id, 'new_member', f'username: {member.username}')
             
         # Проверка возраста аккаунта
-        if settings_data['min_account_age_days'] > 0:
+        if cutoff is not None:
             member_date = getattr(member, 'date', None)
             if member_date:
-                account_age_delta = datetime.now().replace(tzinfo=None) - member_date.replace(tzinfo=None)
-                account_age_days = account_age_delta.days
+                member_date = member_date.replace(tzinfo=None)
                 
-                if account_age_days < settings_data['min_account_age_days']:
+                if member_date > cutoff:
+                    account_age_days = (now - member_date).days
                     try:
                         await context.bot.ban_chat_member(chat.id, member.id)
                         await context.bot.unban_chat_member(chat.id, member.id)
@@ -2090,6 +2351,9 @@ async def new_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         except Exception as e:
             logger.error(f"Error deleting service message: {e}")
             
+# Переменные шаблона приветствия: подставляются буквально, без format-спецификаций и экранирования {{ }}
+_WELCOME_VARS_RE = re.compile(r'\{(name|mention|chat|rules)\}')
+
 async def send_welcome_message(chat: Chat, member: User, settings_data: Dict[str, Any], context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправка стандартного приветственного сообщения"""
     if settings_data['welcome_message']:
@@ -2099,10 +2363,9 @@ async def send_welcome_message(chat: Chat, member: User, settings_data: Dict[str
         user_mention = f'<a href="tg://user?id={member.id}">{user_name}</a>'
         chat_title = chat.title or 'чат'
         
-        welcome_text = welcome_text.replace('{name}', user_name)
-        welcome_text = welcome_text.replace('{mention}', user_mention)
-        welcome_text = welcome_text.replace('{chat}', chat_title)
-        welcome_text = welcome_text.replace('{rules}', 'правилами')
+        substitutions = {'name': user_name, 'mention': user_mention, 'chat': chat_title, 'rules': 'правилами'}
+        # Шаблон пишут админы чатов: format_map выполнил бы {name:>300000000} и съел бы память процесса
+        welcome_text = _WELCOME_VARS_RE.sub(lambda m: substitutions[m.group(1)], welcome_text)
         
         try:
             await context.bot.send_message(
@@ -2182,24 +2445,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not message:
         return
         
-    help_text = """
-🛡️ <b>Команды бота защиты</b>
-
-🎛️ <b>Основные команды:</b>
-/menu - Главное меню управления
-/settings - Быстрые настройки
-/status - Статус защиты
-/enable - Включить бота
-/disable - Выключить бота
-
-💫 <b>Удобное управление:</b>
-• Используйте /menu для полного контроля
-• Настройте защиту в несколько кликов
-• Просматривайте статистику в реальном времени
-
-🚀 <b>Добавьте бота в группу и назначьте администратором!</b>
-    """
-    await message.reply_text(help_text, parse_mode=ParseMode.HTML)
+    await message.reply_text(_HELP_TEXT, parse_mode=ParseMode.HTML)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ошибок"""
@@ -2226,9 +2472,11 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     except Exception as e:
         logger.error(f"Error in error handler: {e}")
 
-async def show_captcha_policy_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
+async def show_captcha_policy_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None,
+        settings_data: Optional[Dict[str, Any]] = None) -> None:
     """Настройки политик капчи"""
-    settings_data = db.get_chat_settings(chat_id)
+    if settings_data is None:
+        settings_data = db.get_chat_settings(chat_id)
     if not settings_data:
         return
     
@@ -2301,12 +2549,7 @@ async def show_captcha_policy_settings(update: Update, context: ContextTypes.DEF
 
 async def show_bot_commands(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
     """Показать список команд бота"""
-    keyboard = [
-        [InlineKeyboardButton("◀️ Назад в помощь", callback_data="help_menu")],
-        [InlineKeyboardButton("🏠 В главное меню", callback_data="main_menu")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _BACK_TO_HELP_KB
     
     text = (
         "📚 <b>Команды бота защиты</b>\n\n"
@@ -2349,16 +2592,7 @@ async def show_bot_commands(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 async def show_setup_guide(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
     """Руководство по настройке защиты"""
-    keyboard = [
-        [
-            InlineKeyboardButton("🛡️ Стандартная настройка", callback_data="standard_preset"),
-            InlineKeyboardButton("🚫 Макс. защита", callback_data="max_preset")
-        ],
-        [InlineKeyboardButton("◀️ Назад в помощь", callback_data="help_menu")],
-        [InlineKeyboardButton("🏠 В главное меню", callback_data="main_menu")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _SETUP_GUIDE_KB
     
     bot_username = getattr(context.bot, 'username', 'your_bot_username')
     
@@ -2417,12 +2651,7 @@ async def show_setup_guide(update: Update, context: ContextTypes.DEFAULT_TYPE, c
 
 async def show_faq(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
     """Часто задаваемые вопросы"""
-    keyboard = [
-        [InlineKeyboardButton("◀️ Назад в помощь", callback_data="help_menu")],
-        [InlineKeyboardButton("🏠 В главное меню", callback_data="main_menu")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _BACK_TO_HELP_KB
     
     text = (
         "❓ <b>Часто задаваемые вопросы</b>\n\n"
@@ -2484,14 +2713,7 @@ async def show_faq(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id:
 
 async def show_support(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
     """Информация о поддержке"""
-    keyboard = [
-        [
-            InlineKeyboardButton("◀️ Назад в помощь", callback_data="help_menu"),
-            InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _SUPPORT_KB
     
     support_info = (
         "🤝 <b>Поддержка и обратная связь</b>\n\n"
@@ -2563,210 +2785,303 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     
     await message.reply_text(chat_info, parse_mode=ParseMode.HTML)
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+_background_tasks: set = set()
+
+async def _later_delete(msg: Message, delay: float) -> None:
+    """Удаление сообщения бота через заданное число секунд"""
+    await asyncio.sleep(delay)
+    with contextlib.suppress(Exception):
+        await msg.delete()
+
+def _schedule_delete(msg: Message, delay: float) -> None:
+    """Планирует отложенное удаление, не задерживая обработчик"""
+    task = asyncio.create_task(_later_delete(msg, delay))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
 async def handle_comments(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ВСЕХ текстовых сообщений (комментариев и обычных сообщений)"""
-    try:
-        message = update.message
-        if not message:
-            return
+    message = update.message
+    if not message:
+        return
 
-        chat = update.effective_chat
-        if not chat:
-            return
+    chat = update.effective_chat
+    if not chat:
+        return
 
-        chat_id = message.chat_id
-        user_id = message.from_user.id
+    chat_id = message.chat_id
+    user_id = message.from_user.id
 
-        if context.user_data and context.user_data.get('awaiting_welcome'):
-            welcome_message = message.text
-            if welcome_message:
-                settings_data = db.get_chat_settings(chat_id)
-                if settings_data:
-                    settings_data['welcome_message'] = welcome_message
-                    db.save_chat_settings(settings_data)
-                    
-                    del context.user_data['awaiting_welcome']
-                    message_id = context.user_data.get('settings_message_id')
-                    if 'settings_message_id' in context.user_data:
-                        del context.user_data['settings_message_id']
-                        
-                    await message.reply_text("✅ Приветственное сообщение обновлено!")
-                    
-                    # Возвращаемся к меню настроек приветствий
-                    if message_id:
-                        await show_welcome_settings(update, context, chat_id, message_id)
-            return
+    state = context.user_data.get(WELCOME_EDIT_KEY) if context.user_data else None
+    if isinstance(state, WelcomeEditState):
+        welcome_message = message.text
+        if welcome_message:
+            settings_data = db.set_field(chat_id, 'welcome_message', welcome_message)
+            if settings_data:
+                del context.user_data[WELCOME_EDIT_KEY]
+                await message.reply_text("✅ Приветственное сообщение обновлено!")
+                
+                # Возвращаемся к меню настроек приветствий
+                if state.settings_message_id:
+                    await show_welcome_settings(update, context, chat_id, state.settings_message_id, settings_data=settings_data)
+        return
 
-        settings = db.get_chat_settings(chat_id)
-        if not settings or not settings['enabled']:
-            return
+    if chat_id in db.disabled_chats:
+        return
 
-        # Проверка капчи (если включена)
-        if settings.get('captcha_enabled', False):
-            captcha_passed = db.check_captcha_passed(chat_id, user_id)
-            if not captcha_passed:
-                try:
-                    await message.delete()
-                    # Отправляем напоминание о капче
-                    reminder_msg = await message.reply_text(
-                        f"⏳ <b>Пройдите проверку безопасности!</b>\n\n"
-                        f"Чтобы писать сообщения, сначала подтвердите, что вы не бот.",
-                        reply_to_message_id=message.message_id
-                    )
-                    # Удаляем напоминание через 5 секунд
-                    await asyncio.sleep(5)
-                    await reminder_msg.delete()
-                    return
-                except Exception as e:
-                    logger.error(f"Error handling captcha check: {e}")
-                    return
-        
-        # Проверка ограничения частоты сообщений (для всех сообщений)
-        if settings.get('message_cooldown_enabled', False):
-            can_send, seconds_remaining = db.check_message_cooldown(chat_id, user_id, 30)
-            if not can_send:
-                try:
-                    await message.delete()
-                    warning_msg = await message.reply_text(
-                        f"⏰ Слишком часто! Отправляйте сообщения не чаще 1 раза в 30 секунд.\n"
-                        f"Попробуйте через {seconds_remaining} сек.",
-                        reply_to_message_id=message.message_id
-                    )
-                    # Удаляем предупреждение через 5 секунд
-                    await asyncio.sleep(5)
-                    await warning_msg.delete()
-                    return
-                except Exception as e:
-                    logger.error(f"Error handling message cooldown: {e}")
-                    return
-        
-        # Проверяем, является ли сообщение комментарием
-        is_comment = False
+    settings = db.get_chat_settings(chat_id)
+    if not settings or not settings['enabled']:
+        return
+
+    # Проверка капчи (если включена)
+    if settings.get('captcha_enabled', False):
+        captcha_passed = db.check_captcha_passed(chat_id, user_id)
+        if not captcha_passed:
+            try:
+                await message.delete()
+                # Отправляем напоминание о капче
+                reminder_msg = await message.reply_text(
+                    f"⏳ <b>Пройдите проверку безопасности!</b>\n\n"
+                    f"Чтобы писать сообщения, сначала подтвердите, что вы не бот.",
+                    reply_to_message_id=message.message_id
+                )
+                # Удаляем напоминание через 5 секунд
+                _schedule_delete(reminder_msg, 5)
+                return
+            except RetryAfter as e:
+                logger.warning(f"Error handling captcha check: flood control, retry after {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                logger.error(f"Error handling captcha check: {e}")
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Error handling captcha check: {e}")
+            return
+    
+    # Проверка ограничения частоты сообщений (для всех сообщений)
+    if settings.get('message_cooldown_enabled', False):
+        can_send, seconds_remaining = db.check_message_cooldown(chat_id, user_id, 30)
+        if not can_send:
+            try:
+                await message.delete()
+                warning_msg = await message.reply_text(
+                    f"⏰ Слишком часто! Отправляйте сообщения не чаще 1 раза в 30 секунд.\n"
+                    f"Попробуйте через {seconds_remaining} сек.",
+                    reply_to_message_id=message.message_id
+                )
+                # Удаляем предупреждение через 5 секунд
+                _schedule_delete(warning_msg, 5)
+                return
+            except RetryAfter as e:
+                logger.warning(f"Error handling message cooldown: flood control, retry after {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                logger.error(f"Error handling message cooldown: {e}")
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Error handling message cooldown: {e}")
+            return
+    
+    # Проверяем, является ли сообщение комментарием
+    is_comment = False
+    
+    # Способ 1: Проверка через message_thread_id (для топиков/форумов)
+    if hasattr(message, 'message_thread_id') and message.message_thread_id is not None:
+        is_comment = True
+        logger.info(f"Обнаружен комментарий через message_thread_id: {message.message_thread_id}")
+        
+    # Способ 2: Проверка, является ли это ответом в обсуждении
+    elif (message.reply_to_message and 
+          hasattr(message.reply_to_message, 'message_thread_id') and 
+          message.reply_to_message.message_thread_id is not None):
+        is_comment = True
+        logger.info(f"Обнаружен комментарий через reply в топике")
+        
+    # Способ 3: Проверка специальных атрибутов для комментариев
+    elif hasattr(message, 'is_topic_message') and message.is_topic_message:
+        is_comment = True
+        logger.info(f"Обнаружен комментарий через is_topic_message")
+        
+    # Способ 4: Проверка для форумов (специальный тип чата)
+    elif hasattr(chat, 'type') and chat.type == 'supergroup' and hasattr(chat, 'is_forum') and chat.is_forum:
+        is_comment = True
+        logger.info(f"Обнаружен комментарий в форуме")
+    
+    settings = db.get_chat_settings(chat_id)
+    if not settings or not settings['enabled']:
+        return
         
-        # Способ 1: Проверка через message_thread_id (для топиков/форумов)
-        if hasattr(message, 'message_thread_id') and message.message_thread_id is not None:
-            is_comment = True
-            logger.info(f"Обнаружен комментарий через message_thread_id: {message.message_thread_id}")
-            
-        # Способ 2: Проверка, является ли это ответом в обсуждении
-        elif (message.reply_to_message and 
-              hasattr(message.reply_to_message, 'message_thread_id') and 
-              message.reply_to_message.message_thread_id is not None):
-            is_comment = True
-            logger.info(f"Обнаружен комментарий через reply в топике")
+    # Если это комментарий, проверяем включена ли защита комментариев
+    if is_comment and not settings.get('protect_comments', True):
+        return
+    
+    # Логируем действие
+    action_type = 'comment_posted' if is_comment else 'message_posted'
+    db.log_action(chat_id, user_id, action_type, f'text: {message.text[:100] if message.text else "no text"}')
+    
+    # Возраст аккаунта считаем один раз: он нужен обеим проверкам комментариев
+    account_age: Optional[int] = None
+    if is_comment:
+        user_created = getattr(message.from_user, 'date', None)
+        if user_created:
+            account_age = (datetime.now().replace(tzinfo=None) - user_created.replace(tzinfo=None)).days
+    
+    # Проверка возраста аккаунта (только для комментариев)
+    if (account_age is not None and settings['min_account_age_days'] > 0
+            and account_age < settings['min_account_age_days']):
+        try:
+            await message.delete()
+            db.log_action(chat_id, user_id, 'comment_deleted', f'young_account_{account_age}days')
             
-        # Способ 3: Проверка специальных атрибутов для комментариев
-        elif hasattr(message, 'is_topic_message') and message.is_topic_message:
-            is_comment = True
-            logger.info(f"Обнаружен комментарий через is_topic_message")
+            # Отправляем предупреждение
+            warning_msg = await message.reply_text(
+                f"❌ Комментарий удален. Аккаунт должен быть старше {settings['min_account_age_days']} дней.",
+                reply_to_message_id=message.message_id
+            )
             
-        # Способ 4: Проверка для форумов (специальный тип чата)
-        elif hasattr(chat, 'type') and chat.type == 'supergroup' and hasattr(chat, 'is_forum') and chat.is_forum:
-            is_comment = True
-            logger.info(f"Обнаружен комментарий в форуме")
-        
-        settings = db.get_chat_settings(chat_id)
-        if not settings or not settings['enabled']:
-            return
+            # Удаляем предупреждение через 5 секунд
+            _schedule_delete(warning_msg, 5)
             
-        # Если это комментарий, проверяем включена ли защита комментариев
-        if is_comment and not settings.get('protect_comments', True):
             return
-        
-        # Логируем действие
-        action_type = 'comment_posted' if is_comment else 'message_posted'
-        db.log_action(chat_id, user_id, action_type, f'text: {message.text[:100] if message.text else "no text"}')
-        
-        # Проверка возраста аккаунта (только для комментариев)
-        if is_comment and settings['min_account_age_days'] > 0:
-            user_created = message.from_user.date
-            if user_created:
-                account_age = (datetime.now().replace(tzinfo=None) - user_created.replace(tzinfo=None)).days
-                if account_age < settings['min_account_age_days']:
+        except RetryAfter as e:
+            logger.warning(f"Error deleting comment from young account: flood control, retry after {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except BadRequest as e:
+            logger.error(f"Error deleting comment from young account: {e}")
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"Error deleting comment from young account: {e}")
+    
+    # Проверка флуд-контроля (для всех сообщений)
+    if settings['anti_flood_enabled']:
+        is_flood = db.check_flood_control(chat_id, user_id)
+        if is_flood:
+            try:
+                await message.delete()
+                action_deleted = 'comment_deleted' if is_comment else 'message_deleted'
+                db.log_action(chat_id, user_id, action_deleted, 'flood_detected')
+                
+                # Добавляем предупреждение
+                warnings_count = db.add_user_warning(chat_id, user_id)
+                
+                flood_msg = await message.reply_text(
+                    f"⚠️ Флуд-контроль! Предупреждение {warnings_count}/{settings['max_warnings']}",
+                    reply_to_message_id=message.message_id
+                )
+                
+                # Проверяем лимит предупреждений
+                if warnings_count >= settings['max_warnings']:
                     try:
-                        await message.delete()
-                        db.log_action(chat_id, user_id, 'comment_deleted', f'young_account_{account_age}days')
+                        await context.bot.ban_chat_member(chat_id, user_id)
+                        await context.bot.unban_chat_member(chat_id, user_id)
+                        ban_type = 'max_warnings_comments' if is_comment else 'max_warnings_messages'
+                        db.log_action(chat_id, user_id, 'user_banned', ban_type)
                         
-                        # Отправляем предупреждение
-                        warning_msg = await message.reply_text(
-                            f"❌ Комментарий удален. Аккаунт должен быть старше {settings['min_account_age_days']} дней.",
+                        ban_msg = await message.reply_text(
+                            "🚫 Пользователь забанен за превышение лимита предупреждений",
                             reply_to_message_id=message.message_id
                         )
-                        
-                        # Удаляем предупреждение через 5 секунд
-                        await asyncio.sleep(5)
-                        await warning_msg.delete()
-                        
-                        return
-                    except Exception as e:
-                        logger.error(f"Error deleting comment from young account: {e}")
-        
-        # Проверка флуд-контроля (для всех сообщений)
-        if settings['anti_flood_enabled']:
-            is_flood = db.check_flood_control(chat_id, user_id)
-            if is_flood:
-                try:
-                    await message.delete()
-                    action_deleted = 'comment_deleted' if is_comment else 'message_deleted'
-                    db.log_action(chat_id, user_id, action_deleted, 'flood_detected')
-                    
-                    # Добавляем предупреждение
-                    warnings_count = db.add_user_warning(chat_id, user_id)
-                    
-                    flood_msg = await message.reply_text(
-                        f"⚠️ Флуд-контроль! Предупреждение {warnings_count}/{settings['max_warnings']}",
-                        reply_to_message_id=message.message_id
-                    )
-                    
-                    # Проверяем лимит предупреждений
-                    if warnings_count >= settings['max_warnings']:
-                        try:
-                            await context.bot.ban_chat_member(chat_id, user_id)
-                            await context.bot.unban_chat_member(chat_id, user_id)
-                            ban_type = 'max_warnings_comments' if is_comment else 'max_warnings_messages'
-                            db.log_action(chat_id, user_id, 'user_banned', ban_type)
-                            
-                            ban_msg = await message.reply_text(
-                                "🚫 Пользователь забанен за превышение лимита предупреждений",
-                                reply_to_message_id=message.message_id
-                            )
-                            await asyncio.sleep(10)
-                            await ban_msg.delete()
-                        except Exception as e:
-                            logger.error(f"Error banning user for flood: {e}")
-                    
-                    await asyncio.sleep(5)
-                    await flood_msg.delete()
-                    return
-                    
-                except Exception as e:
-                    logger.error(f"Error handling flood: {e}")
-        
-        # Проверка на спам-слова (только для комментариев)
-        if is_comment and message.text:
-            spam_keywords = ["http://", "https://", "купить", "заказать", "скидка", "распродажа"]
-            if any(keyword in message.text.lower() for keyword in spam_keywords):
-                # Проверяем возраст аккаунта для ссылок
-                user_created = message.from_user.date
-                if user_created:
-                    account_age = (datetime.now().replace(tzinfo=None) - user_created.replace(tzinfo=None)).days
-                    if account_age < 7:  # Строгая проверка для ссылок
-                        try:
-                            await message.delete()
-                            db.log_action(chat_id, user_id, 'comment_deleted', 'spam_link_detected')
-                            
-                            spam_msg = await message.reply_text(
-                                "❌ Ссылки запрещены для новых аккаунтов",
-                                reply_to_message_id=message.message_id
-                            )
-                            await asyncio.sleep(5)
-                            await spam_msg.delete()
-                            return
-                        except Exception as e:
-                            logger.error(f"Error deleting spam comment: {e}")
-                        
-    except Exception as e:
-        logger.error(f"Error in handle_comments: {e}")
+                        _schedule_delete(ban_msg, 10)
+                    except RetryAfter as e:
+                        logger.warning(f"Error banning user for flood: flood control, retry after {e.retry_after}s")
+                        await asyncio.sleep(e.retry_after)
+                    except BadRequest as e:
+                        logger.error(f"Error banning user for flood: {e}")
+                    except (TimedOut, NetworkError) as e:
+                        logger.warning(f"Error banning user for flood: {e}")
+                
+                _schedule_delete(flood_msg, 5)
+                return
+                
+            except RetryAfter as e:
+                logger.warning(f"Error handling flood: flood control, retry after {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                logger.error(f"Error handling flood: {e}")
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Error handling flood: {e}")
+    
+    # Проверка на спам-слова (только для комментариев от аккаунтов моложе 7 дней)
+    if account_age is not None and account_age < 7 and message.text:
+        spam_keywords = ["http://", "https://", "купить", "заказать", "скидка", "распродажа"]
+        if any(keyword in message.text.lower() for keyword in spam_keywords):
+            try:
+                await message.delete()
+                db.log_action(chat_id, user_id, 'comment_deleted', 'spam_link_detected')
+                
+                spam_msg = await message.reply_text(
+                    "❌ Ссылки запрещены для новых аккаунтов",
+                    reply_to_message_id=message.message_id
+                )
+                _schedule_delete(spam_msg, 5)
+                return
+            except RetryAfter as e:
+                logger.warning(f"Error deleting spam comment: flood control, retry after {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                logger.error(f"Error deleting spam comment: {e}")
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Error deleting spam comment: {e}")
+
+# Шаблоны экранов настроек комментариев (форматируются через str.format)
+_FLOOD_SETTINGS_TMPL = (
+    "🌊 <b>Настройки флуд-контроля</b>\n\n"
+    
+    "<b>Текущие параметры:</b>\n"
+    "• Флуд-контроль: <b>{flood}</b>\n"
+    "• Для комментариев: <b>{comments}</b>\n"
+    "• Лимит сообщений: <b>5 сообщений</b>\n"
+    "• Временное окно: <b>10 секунд</b>\n\n"
+    
+    "<b>📊 Статистика флуда:</b>\n"
+    "• Событий за час: <b>{events}</b>\n"
+    "• Пользователей за 24ч: <b>{users}</b>\n\n"
+    
+    "<b>💡 Как работает:</b>\n"
+    "• Система отслеживает количество сообщений\n"
+    "• Если больше 5 сообщений за 10 секунд - флуд\n"
+    "• При флуде - удаление + предупреждение\n"
+    "• При 3+ предупреждениях - автоматический бан\n\n"
+    
+    "💡 <i>Флуд-контроль применяется к комментариям и основному чату</i>"
+)
+
+_COMMENTS_SETTINGS_TMPL = (
+    "💬 <b>Защита комментариев</b>\n\n"
+    "<b>Текущий статус:</b> {status}\n\n"
+    
+    "<b>📊 Статистика за 7 дней:</b>\n"
+    "• Обработано комментариев: <b>{posted}</b>\n"
+    "• Удалено комментариев: <b>{deleted}</b>\n"
+    "• Эффективность: <b>{eff:.1f}%</b>\n\n"
+    
+    "<b>🛡️ Активные защиты:</b>\n"
+    "• Проверка возраста аккаунта\n"
+    "• Флуд-контроль\n"
+    "• Фильтр спам-ссылок\n"
+    "• Система предупреждений\n\n"
+    
+    "💡 <i>Защита применяет те же правила, что и для основного чата</i>"
+)
+
+_COMMENTS_STATS_TMPL = (
+    "📊 <b>Статистика комментариев</b>\n\n"
+    
+    "<b>📈 Общая статистика (30 дней):</b>\n"
+    "• Всего комментариев: <b>{total}</b>\n"
+    "• Удалено комментариев: <b>{deleted}</b>\n"
+    "• Заблокировано спама: <b>{spam}</b>\n"
+    "• Эффективность: <b>{eff:.1f}%</b>\n\n"
+    
+    "<b>🛡️ Детали защиты:</b>\n"
+    "• Молодые аккаунты: <b>{young}</b>\n"
+    "• Флуд: <b>{flood}</b>\n"
+    "• Спам-ссылки: <b>{spam_links}</b>\n\n"
+    
+    "<b>🏆 Топ комментаторов:</b>\n"
+    "{top}\n"
+    
+    "<b>💡 Аналитика:</b>\n"
+    "{analytics}"
+)
 
 async def show_flood_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
     """Настройки флуд-контроля для комментариев"""
@@ -2816,36 +3131,22 @@ async def show_flood_settings(update: Update, context: ContextTypes.DEFAULT_TYPE
         recent_flood_events = 0
         flood_users_24h = 0
     
-    text = (
-        f"🌊 <b>Настройки флуд-контроля</b>\n\n"
-        
-        f"<b>Текущие параметры:</b>\n"
-        f"• Флуд-контроль: <b>{'ВКЛ' if settings_data['anti_flood_enabled'] else 'ВЫКЛ'}</b>\n"
-        f"• Для комментариев: <b>{'ВКЛ' if settings_data.get('protect_comments', True) else 'ВЫКЛ'}</b>\n"
-        f"• Лимит сообщений: <b>5 сообщений</b>\n"
-        f"• Временное окно: <b>10 секунд</b>\n\n"
-        
-        f"<b>📊 Статистика флуда:</b>\n"
-        f"• Событий за час: <b>{recent_flood_events}</b>\n"
-        f"• Пользователей за 24ч: <b>{flood_users_24h}</b>\n\n"
-        
-        f"<b>💡 Как работает:</b>\n"
-        f"• Система отслеживает количество сообщений\n"
-        f"• Если больше 5 сообщений за 10 секунд - флуд\n"
-        f"• При флуде - удаление + предупреждение\n"
-        f"• При 3+ предупреждениях - автоматический бан\n\n"
-        
-        f"💡 <i>Флуд-контроль применяется к комментариям и основному чату</i>"
+    text = _FLOOD_SETTINGS_TMPL.format(
+        flood='ВКЛ' if settings_data['anti_flood_enabled'] else 'ВЫКЛ',
+        comments='ВКЛ' if settings_data.get('protect_comments', True) else 'ВЫКЛ',
+        events=recent_flood_events,
+        users=flood_users_24h
     )
     
     if message_id:
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=text,
-            reply_markup=reply_markup,
-            parse_mode=ParseMode.HTML
-        )
+        success = await safe_edit_message(context, chat_id, message_id, text, reply_markup)
+        if not success:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML
+            )
     else:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -2859,29 +3160,14 @@ async def toggle_comments_protection(update: Update, context: ContextTypes.DEFAU
     try:
         logger.info(f"Начало toggle_comments_protection для чата {chat_id}")
         
-        settings_data = db.get_chat_settings(chat_id)
+        settings_data = db.toggle_field(chat_id, 'protect_comments')
         if not settings_data:
-            logger.error(f"Не удалось загрузить настройки для чата {chat_id}")
+            logger.error(f"Не удалось изменить настройки для чата {chat_id}")
             await update.callback_query.answer("❌ Ошибка загрузки настроек")
             return
-            
-        # Получаем текущее значение защиты комментариев
-        current_value = settings_data.get('protect_comments', True)
-        logger.info(f"Текущее значение protect_comments: {current_value}")
-        
-        # Инвертируем значение
-        new_value = not current_value
-        settings_data['protect_comments'] = new_value
         
+        new_value = settings_data['protect_comments']
         logger.info(f"Новое значение protect_comments: {new_value}")
-        
-        # Сохраняем настройки
-        db.save_chat_settings(settings_data)
-        logger.info("Настройки сохранены в БД")
-        
-        settings_data_after_save = db.get_chat_settings(chat_id)
-        if settings_data_after_save:
-            logger.info(f"Проверка после сохранения - protect_comments: {settings_data_after_save.get('protect_comments')}")
             
         # Формируем текст ответа
         status = "включена" if new_value else "выключена"
@@ -2889,19 +3175,21 @@ async def toggle_comments_protection(update: Update, context: ContextTypes.DEFAU
         logger.info(f"Отправлен ответ: Защита комментариев {status}")
         
         # Обновляем сообщение с настройками
-        await show_comments_settings(update, context, chat_id, message_id)
+        await show_comments_settings(update, context, chat_id, message_id, settings_data=settings_data)
         logger.info("Сообщение с настройками обновлено")
         
     except Exception as e:
         logger.error(f"Error in toggle_comments_protection: {e}")
         await update.callback_query.answer("❌ Ошибка при изменении настроек")
         
-async def show_comments_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
+async def show_comments_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None,
+        settings_data: Optional[Dict[str, Any]] = None) -> None:
     """Настройки защиты комментариев"""
     try:
         logger.info(f"Начало show_comments_settings для чата {chat_id}")
         
-        settings_data = db.get_chat_settings(chat_id)
+        if settings_data is None:
+            settings_data = db.get_chat_settings(chat_id)
         if not settings_data:
             logger.error(f"Не удалось загрузить настройки для чата {chat_id}")
             return
@@ -2928,12 +3216,9 @@ async def show_comments_settings(update: Update, context: ContextTypes.DEFAULT_T
         
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        stats = db.get_statistics(chat_id, 7)
-        comments_stats = stats.get('actions', {}).get('comment_posted', 0)
-        comments_deleted = stats.get('actions', {}).get('comment_deleted', 0)
-        
-        # Добавляем временную метку для уникальности сообщения
-        timestamp = datetime.now().strftime("%H:%M:%S")
+        weekly_actions = db.get_weekly_action_counts(chat_id)
+        comments_stats = weekly_actions.get('comment_posted', 0)
+        comments_deleted = weekly_actions.get('comment_deleted', 0)
         
         # Безопасный расчет эффективности
         if comments_stats > 0:
@@ -2941,23 +3226,11 @@ async def show_comments_settings(update: Update, context: ContextTypes.DEFAULT_T
         else:
             efficiency = 0
         
-        text = (
-            f"💬 <b>Защита комментариев</b>\n\n"
-            f"<b>Текущий статус:</b> {'🟢 ВКЛЮЧЕНА' if protect_comments else '🔴 ВЫКЛЮЧЕНА'}\n\n"
-            
-            f"<b>📊 Статистика за 7 дней:</b>\n"
-            f"• Обработано комментариев: <b>{comments_stats}</b>\n"
-            f"• Удалено комментариев: <b>{comments_deleted}</b>\n"
-            f"• Эффективность: <b>{efficiency:.1f}%</b>\n\n"
-            
-            f"<b>🛡️ Активные защиты:</b>\n"
-            f"• Проверка возраста аккаунта\n"
-            f"• Флуд-контроль\n"
-            f"• Фильтр спам-ссылок\n"
-            f"• Система предупреждений\n\n"
-            
-            f"💡 <i>Защита применяет те же правила, что и для основного чата</i>\n"
-            f"<i>Обновлено: {timestamp}</i>"  # Добавляем временную метку
+        text = _COMMENTS_SETTINGS_TMPL.format(
+            status='🟢 ВКЛЮЧЕНА' if protect_comments else '🔴 ВЫКЛЮЧЕНА',
+            posted=comments_stats,
+            deleted=comments_deleted,
+            eff=efficiency
         )
         
         if message_id:
@@ -3015,16 +3288,7 @@ async def show_comments_stats(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Error getting top commenters: {e}")
         top_commenters = []
     
-    keyboard = [
-        [InlineKeyboardButton("🔄 Обновить", callback_data="comments_stats")],
-        [InlineKeyboardButton("⚙️ Настройки комментариев", callback_data="comments_settings")],
-        [
-            InlineKeyboardButton("◀️ Назад", callback_data="comments_settings"),
-            InlineKeyboardButton("🏠 В главное", callback_data="main_menu")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _COMMENTS_STATS_KB
     
     # Форматируем статистику комментариев
     total_comments = comments_actions.get('comment_posted', 0)
@@ -3049,38 +3313,30 @@ async def show_comments_stats(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not top_commenters_text:
         top_commenters_text = "• Нет данных\n"
     
-    text = (
-        f"📊 <b>Статистика комментариев</b>\n\n"
-        
-        f"<b>📈 Общая статистика (30 дней):</b>\n"
-        f"• Всего комментариев: <b>{total_comments}</b>\n"
-        f"• Удалено комментариев: <b>{deleted_comments}</b>\n"
-        f"• Заблокировано спама: <b>{spam_blocked}</b>\n"
-        f"• Эффективность: <b>{efficiency_rate:.1f}%</b>\n\n"
-        
-        f"<b>🛡️ Детали защиты:</b>\n"
-        f"• Молодые аккаунты: <b>{comments_actions.get('comment_deleted_young_account', 0)}</b>\n"
-        f"• Флуд: <b>{comments_actions.get('comment_deleted_flood', 0)}</b>\n"
-        f"• Спам-ссылки: <b>{comments_actions.get('comment_deleted_spam', 0)}</b>\n\n"
-        
-        f"<b>🏆 Топ комментаторов:</b>\n"
-        f"{top_commenters_text}\n"
-        
-        f"<b>💡 Аналитика:</b>\n"
-    )
-    
-    # Добавляем аналитику
+    # Аналитика
     if total_comments == 0:
-        text += "• Комментарии еще не поступали\n"
+        analytics_line = "• Комментарии еще не поступали\n"
     elif efficiency_rate > 20:
-        text += f"• Высокий уровень спама ({efficiency_rate:.1f}%)\n"
+        analytics_line = f"• Высокий уровень спама ({efficiency_rate:.1f}%)\n"
     elif efficiency_rate > 5:
-        text += f"• Умеренный уровень спама ({efficiency_rate:.1f}%)\n"
+        analytics_line = f"• Умеренный уровень спама ({efficiency_rate:.1f}%)\n"
     else:
-        text += f"• Низкий уровень спама ({efficiency_rate:.1f}%)\n"
+        analytics_line = f"• Низкий уровень спама ({efficiency_rate:.1f}%)\n"
     
     if deleted_comments > 0:
-        text += f"• Защита активно работает\n"
+        analytics_line += "• Защита активно работает\n"
+    
+    text = _COMMENTS_STATS_TMPL.format(
+        total=total_comments,
+        deleted=deleted_comments,
+        spam=spam_blocked,
+        eff=efficiency_rate,
+        young=comments_actions.get('comment_deleted_young_account', 0),
+        flood=comments_actions.get('comment_deleted_flood', 0),
+        spam_links=comments_actions.get('comment_deleted_spam', 0),
+        top=top_commenters_text,
+        analytics=analytics_line
+    )
     
     if message_id:
         await context.bot.edit_message_text(
@@ -3098,9 +3354,11 @@ async def show_comments_stats(update: Update, context: ContextTypes.DEFAULT_TYPE
             parse_mode=ParseMode.HTML
         )
 
-async def show_cooldown_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
+async def show_cooldown_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None,
+        settings_data: Optional[Dict[str, Any]] = None) -> None:
     """Настройки ограничения частоты сообщений"""
-    settings_data = db.get_chat_settings(chat_id)
+    if settings_data is None:
+        settings_data = db.get_chat_settings(chat_id)
     if not settings_data:
         return
     
@@ -3140,9 +3398,6 @@ async def show_cooldown_settings(update: Update, context: ContextTypes.DEFAULT_T
         recent_blocks = 0
         affected_users = 0
     
-    # Добавляем временную метку для уникальности сообщения
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    
     text = (
         f"⏰ <b>Ограничение частоты сообщений</b>\n\n"
         
@@ -3161,8 +3416,7 @@ async def show_cooldown_settings(update: Update, context: ContextTypes.DEFAULT_T
         f"• Для уменьшения флуда\n"
         f"• В важных деловых чатах\n\n"
         
-        f"💡 <i>Ограничение применяется ко всем сообщениям и комментариям</i>\n"
-        f"<i>Обновлено: {timestamp}</i>"  # Добавляем временную метку
+        f"💡 <i>Ограничение применяется ко всем сообщениям и комментариям</i>"
     )
     
     if message_id:
@@ -3352,6 +3606,10 @@ async def handle_captcha_callback(update: Update, context: ContextTypes.DEFAULT_
     except Exception as e:
         logger.error(f"❌ Error handling captcha callback: {e}")
 
+async def refresh_weekly_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обновление недельной статистики (запускается по расписанию)"""
+    db.refresh_weekly_stats()
+
 async def check_captcha_expired(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Проверка просроченных капч (запускается по расписанию)"""
     try:
@@ -3364,38 +3622,40 @@ async def check_captcha_expired(context: ContextTypes.DEFAULT_TYPE) -> None:
                     WHERE expires_at < CURRENT_TIMESTAMP AND captcha_passed = FALSE
                 ''')
                 expired_captchas = cursor.fetchall()
-
-                for chat_id, user_id, message_id in expired_captchas:
-                    try:
-                        # Кикаем пользователя
-                        await context.bot.ban_chat_member(chat_id, user_id)
-                        await context.bot.unban_chat_member(chat_id, user_id)
-                        
-                        # Редактируем сообщение с капчей
-                        await context.bot.edit_message_text(
-                            chat_id=chat_id,
-                            message_id=message_id,
-                            text="⏰ <b>Время проверки истекло</b>\n\nПользователь был удален из чата.",
-                            parse_mode=ParseMode.HTML
-                        )
-                        
-                        # Удаляем капчу из базы
-                        db.delete_captcha(chat_id, user_id)
-                        
-                        db.log_action(chat_id, user_id, 'user_banned', 'captcha_timeout')
-                        logger.info(f"User {user_id} kicked for captcha timeout in chat {chat_id}")
-                        
-                    except Exception as e:
-                        logger.error(f"Error handling expired captcha for user {user_id}: {e}")
-                        # Все равно удаляем капчу из базы
-                        db.delete_captcha(chat_id, user_id)
+        
+        for chat_id, user_id, message_id in expired_captchas:
+            try:
+                # Кикаем пользователя
+                await context.bot.ban_chat_member(chat_id, user_id)
+                await context.bot.unban_chat_member(chat_id, user_id)
+                
+                # Редактируем сообщение с капчей
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text="⏰ <b>Время проверки истекло</b>\n\nПользователь был удален из чата.",
+                    parse_mode=ParseMode.HTML
+                )
+                
+                # Удаляем капчу из базы
+                db.delete_captcha(chat_id, user_id)
+                
+                db.log_action(chat_id, user_id, 'user_banned', 'captcha_timeout')
+                logger.info(f"User {user_id} kicked for captcha timeout in chat {chat_id}")
+                
+            except Exception as e:
+                logger.error(f"Error handling expired captcha for user {user_id}: {e}")
+                # Все равно удаляем капчу из базы
+                db.delete_captcha(chat_id, user_id)
 
     except Exception as e:
         logger.error(f"Error checking expired captchas: {e}")
         
-async def show_captcha_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None) -> None:
+async def show_captcha_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: Optional[int] = None,
+        settings_data: Optional[Dict[str, Any]] = None) -> None:
     """Настройки капчи"""
-    settings_data = db.get_chat_settings(chat_id)
+    if settings_data is None:
+        settings_data = db.get_chat_settings(chat_id)
     if not settings_data:
         return
     
@@ -3444,9 +3704,6 @@ async def show_captcha_settings(update: Update, context: ContextTypes.DEFAULT_TY
         'always': '🚫 Всегда'
     }
     
-    # Добавляем временную метку для уникальности сообщения
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    
     text = (
         f"🤖 <b>Настройки капчи</b>\n\n"
         
@@ -3469,8 +3726,7 @@ async def show_captcha_settings(update: Update, context: ContextTypes.DEFAULT_TY
         f"• При неудаче - удаление из чата\n"
         f"• При успехе - полный доступ к чату\n\n"
         
-        f"💡 <i>Эффективно против ботов и спамеров</i>\n"
-        f"<i>Обновлено: {timestamp}</i>"
+        f"💡 <i>Эффективно против ботов и спамеров</i>"
     )
     
     if message_id:
@@ -3491,11 +3747,33 @@ async def show_captcha_settings(update: Update, context: ContextTypes.DEFAULT_TY
             parse_mode=ParseMode.HTML
         )
         
+def _install_uvloop() -> None:
+    """Переключение asyncio на uvloop, если он установлен"""
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop не установлен, используется стандартный цикл событий asyncio")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Используется цикл событий uvloop")
+
 def main() -> None:
     """Основная функция запуска бота"""
     try:
+        # Политика цикла событий должна быть установлена до запуска run_polling
+        _install_uvloop()
         token = cast(str, BOT_TOKEN)
-        application = Application.builder().token(token).build()
+        # Общий пул HTTP/2-соединений с Bot API: параллельные запросы мультиплексируются
+        # через несколько TLS-соединений вместо ожидания свободного соединения
+        application = (
+            Application.builder()
+            .token(token)
+            .connection_pool_size(256)
+            .pool_timeout(5.0)
+            .http_version("2")
+            .get_updates_http_version("2")
+            .build()
+        )
         
         # ВАЖНО: сначала обработчик капчи с паттерном, потом общий обработчик
         application.add_handler(CallbackQueryHandler(
@@ -3530,6 +3808,7 @@ def main() -> None:
         job_queue = application.job_queue
         if job_queue:
             job_queue.run_repeating(check_captcha_expired, interval=60, first=10)
+            job_queue.run_repeating(refresh_weekly_stats, interval=60, first=60)
         
         application.add_error_handler(error_handler)
         
@@ -1,110 +1,95 @@
+import contextlib
 import unittest
-from unittest.mock import Mock, patch, call
+from unittest.mock import DEFAULT, Mock, call, patch
 import sys
-import os
 
+from telegram.ext import Application, ApplicationBuilder
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from bot import main
+
+# Ожидаемые команды: (команда, имя функции-обработчика в bot)
+_EXPECTED_COMMANDS = (
+    ("start", "start"),
+    ("menu", "menu"),
+    ("settings", "menu"),  # Перенаправление на menu
+    ("status", "menu"),    # Перенаправление на menu
+    ("enable", "enable_bot"),
+    ("disable", "disable_bot"),
+    ("help", "help_command"),
+)
+_COMMAND_HANDLER_NAMES = frozenset(name for _, name in _EXPECTED_COMMANDS)
+# Шаги цепочки ApplicationBuilder в main(), каждый возвращает тот же builder
+_BUILDER_CHAIN = ("token", "connection_pool_size", "pool_timeout", "http_version", "get_updates_http_version")
 
 
 class TestMainFunction(unittest.TestCase):
-    """Тесты для основной функции запуска бота main()"""
+    """Тесты для основной функции запуска бота main()
+
+    Все глобальное состояние патчится на время теста, поэтому тесты можно
+    запускать параллельно (pytest -n auto, см. run_tests.py).
+    """
     
     def setUp(self) -> None:
         """Настройка перед каждым тестом"""
-        self.original_exit = sys.exit
-        sys.exit = Mock()
+        # Общие патчи всех тестов main(): sys.exit, логгер, Application и токен
+        self._patchers = contextlib.ExitStack()
+        self._patchers.enter_context(patch.object(sys, 'exit'))
+        # Установка uvloop меняет политику цикла событий всего процесса и задела бы соседние async-тесты
+        self._patchers.enter_context(patch('bot._install_uvloop'))
+        self.mock_logger = self._patchers.enter_context(patch('bot.logger'))
+        self._patchers.enter_context(patch('bot.BOT_TOKEN', 'test_token'))
+        
+        # spec_set: моки принимают только настоящие атрибуты PTB, опечатки в тестах и в main() сразу падают
+        # run_polling сразу завершается
+        self.mock_app_instance = Mock(spec_set=Application, **{'run_polling.return_value': None})
+        
+        # Мокаем Application builder: каждый шаг цепочки возвращает тот же builder
+        self.mock_builder = Mock(spec_set=ApplicationBuilder)
+        self.mock_builder.configure_mock(**{f'{step}.return_value': self.mock_builder for step in _BUILDER_CHAIN},
+                                         **{'build.return_value': self.mock_app_instance})
+        self.mock_application = self._patchers.enter_context(
+            patch('bot.Application', spec_set=Application, **{'builder.return_value': self.mock_builder}))
     
     def tearDown(self) -> None:
         """Очистка после каждого теста"""
-        sys.exit = self.original_exit
+        self._patchers.close()
     
-    @patch('bot.logger')
-    @patch('bot.Application')
-    @patch('bot.BOT_TOKEN', 'test_token')
-    def test_main_successful_startup(self, mock_application: Mock, mock_logger: Mock) -> None:
+    def test_main_successful_startup(self) -> None:
         """Тест успешного запуска бота"""
-        # Мокаем Application builder
-        mock_builder = Mock()
-        mock_application.builder.return_value = mock_builder
-        mock_app_instance = Mock()
-        mock_builder.token.return_value = mock_builder
-        mock_builder.build.return_value = mock_app_instance
-        
-        # Мокаем run_polling чтобы он сразу завершался
-        mock_app_instance.run_polling.return_value = None
-        
-        # Импортируем main после настройки моков
-        from bot import main
-        
         # Вызываем функцию
         main()
         
         # Проверяем что Application был создан с правильным токеном
-        mock_application.builder.assert_called_once()
-        mock_builder.token.assert_called_once_with('test_token')
-        mock_builder.build.assert_called_once()
+        self.mock_application.builder.assert_called_once()
+        self.mock_builder.token.assert_called_once_with('test_token')
+        self.mock_builder.build.assert_called_once()
         
         # Проверяем что обработчики были добавлены
-        self.assertGreaterEqual(mock_app_instance.add_handler.call_count, 9)
+        self.assertGreaterEqual(self.mock_app_instance.add_handler.call_count, 9)
         
         # Проверяем что был вызван run_polling
-        mock_app_instance.run_polling.assert_called_once()
+        self.mock_app_instance.run_polling.assert_called_once()
         
         # Проверяем логирование
-        mock_logger.info.assert_called_with("Бот запускается...")
+        self.mock_logger.info.assert_any_call("Бот запускается...")
     
-    @patch('bot.logger')
-    @patch('bot.Application')
-    @patch('bot.BOT_TOKEN', 'test_token')
-    def test_main_handler_registration(self, mock_application: Mock, mock_logger: Mock) -> None:
+    def test_main_handler_registration(self) -> None:
         """Тест регистрации всех обработчиков"""
-        # Мокаем Application
-        mock_builder = Mock()
-        mock_application.builder.return_value = mock_builder
-        mock_app_instance = Mock()
-        mock_builder.token.return_value = mock_builder
-        mock_builder.build.return_value = mock_app_instance
-        
-        # Мокаем run_polling чтобы он сразу завершался
-        mock_app_instance.run_polling.return_value = None
-        
-        from bot import main
-        
         # Вызываем функцию
         main()
         
         # Получаем все вызовы add_handler
-        handler_calls = mock_app_instance.add_handler.call_args_list
+        handler_calls = self.mock_app_instance.add_handler.call_args_list
         
         # Проверяем количество обработчиков (примерное)
         self.assertGreaterEqual(len(handler_calls), 9)
     
-    @patch('bot.logger')
-    @patch('bot.Application')
-    @patch('bot.BOT_TOKEN', 'test_token')
-    def test_main_specific_command_handlers(self, mock_application: Mock, mock_logger: Mock) -> None:
+    def test_main_specific_command_handlers(self) -> None:
         """Тест конкретных командных обработчиков"""
-        # Мокаем Application
-        mock_builder = Mock()
-        mock_application.builder.return_value = mock_builder
-        mock_app_instance = Mock()
-        mock_builder.token.return_value = mock_builder
-        mock_builder.build.return_value = mock_app_instance
-        
-        # Мокаем run_polling чтобы он сразу завершался
-        mock_app_instance.run_polling.return_value = None
-        
-        from bot import main
-        
         # Мокаем конкретные функции
-        with patch('bot.start') as mock_start, \
-            patch('bot.menu') as mock_menu, \
-            patch('bot.enable_bot') as mock_enable, \
-            patch('bot.disable_bot') as mock_disable, \
-            patch('bot.help_command') as mock_help, \
-            patch('bot.button_handler') as mock_button:
-            
+        with patch.multiple('bot', **{name: DEFAULT for name in _COMMAND_HANDLER_NAMES}) as handler_mocks, \
+             patch('bot.button_handler') as mock_button, \
+             patch('bot.handle_captcha_callback') as mock_captcha:
             
             # Мокаем CommandHandler и другие классы
             with patch('bot.CommandHandler') as mock_cmd_handler, \
@@ -113,131 +98,68 @@ class TestMainFunction(unittest.TestCase):
                 # Вызываем функцию
                 main()
                 
-                # Проверяем вызовы CommandHandler
-                expected_command_calls = [
-                    call("start", mock_start),
-                    call("menu", mock_menu),
-                    call("settings", mock_menu),  # Перенаправление на menu
-                    call("status", mock_menu),    # Перенаправление на menu
-                    call("enable", mock_enable),
-                    call("disable", mock_disable),
-                    call("help", mock_help)
+                # Один проход по вызовам CommandHandler вместо поиска каждой команды в списке
+                registered = {(c.args[0], c.args[1]) for c in mock_cmd_handler.call_args_list if len(c.args) == 2}
+                missing = [
+                    (command, name) for command, name in _EXPECTED_COMMANDS
+                    if (command, handler_mocks[name]) not in registered
                 ]
+                self.assertFalse(missing, f"Missing command handlers: {missing}")
                 
-                # Проверяем что CommandHandler вызывался с правильными параметрами
-                for expected_call in expected_command_calls:
-                    self.assertIn(expected_call, mock_cmd_handler.call_args_list)
-                
-                # Проверяем CallbackQueryHandler
-                mock_callback_handler.assert_called_once_with(mock_button)
+                # Проверяем CallbackQueryHandler: общий обработчик кнопок и обработчик капчи
+                mock_callback_handler.assert_any_call(mock_button)
+                # Капча регистрируется раньше общего обработчика, иначе button_handler перехватил бы ее кнопки
+                mock_callback_handler.assert_has_calls([
+                    call(mock_captcha, pattern="^captcha_(verify|bot)_"),
+                    call(mock_button),
+                ])
     
-    @patch('bot.logger')
-    @patch('bot.Application')
-    @patch('bot.BOT_TOKEN', 'test_token')
-    def test_main_token_casting(self, mock_application: Mock, mock_logger: Mock) -> None:
+    def test_main_token_casting(self) -> None:
         """Тест приведения типа токена"""
-        mock_builder = Mock()
-        mock_application.builder.return_value = mock_builder
-        mock_app_instance = Mock()
-        mock_builder.token.return_value = mock_builder
-        mock_builder.build.return_value = mock_app_instance
-        
-        # Мокаем run_polling чтобы он сразу завершался
-        mock_app_instance.run_polling.return_value = None
-        
-        from bot import main
-        
         # Вызываем функцию
         main()
         
         # Проверяем что токен был передан как строка
-        mock_builder.token.assert_called_once_with('test_token')
+        self.mock_builder.token.assert_called_once_with('test_token')
+        
+        # Проверяем настройки HTTP-клиента Bot API
+        self.mock_builder.connection_pool_size.assert_called_once_with(256)
+        self.mock_builder.pool_timeout.assert_called_once_with(5.0)
+        self.mock_builder.http_version.assert_called_once_with("2")
+        self.mock_builder.get_updates_http_version.assert_called_once_with("2")
     
     
     
-    @patch('bot.logger')
-    @patch('bot.Application')
-    @patch('bot.BOT_TOKEN', 'test_token')
-    def test_main_application_exception(self, mock_application: Mock, mock_logger: Mock) -> None:
+    def test_main_application_exception(self) -> None:
         """Тест обработки исключения при создании Application"""
         # Мокаем исключение при создании Application
-        mock_application.builder.side_effect = Exception("Application creation failed")
-        
-        from bot import main
+        self.mock_application.builder.side_effect = Exception("Application creation failed")
         
         # Вызываем функцию
         main()
         
         # Проверяем что ошибка была залогирована
-        mock_logger.error.assert_called_with("Bot error: Application creation failed")
+        self.mock_logger.error.assert_called_with("Bot error: Application creation failed")
     
-    @patch('bot.logger')
-    @patch('bot.Application')
-    @patch('bot.BOT_TOKEN', 'test_token')
-    def test_main_run_polling_exception(self, mock_application: Mock, mock_logger: Mock) -> None:
+    def test_main_run_polling_exception(self) -> None:
         """Тест обработки исключения при запуске polling"""
-        # Мокаем Application
-        mock_builder = Mock()
-        mock_application.builder.return_value = mock_builder
-        mock_app_instance = Mock()
-        mock_builder.token.return_value = mock_builder
-        mock_builder.build.return_value = mock_app_instance
-        
         # Мокаем исключение при run_polling
-        mock_app_instance.run_polling.side_effect = Exception("Polling failed")
-        
-        from bot import main
+        self.mock_app_instance.run_polling.side_effect = Exception("Polling failed")
         
         # Вызываем функцию
         main()
         
         # Проверяем что ошибка была залогирована
-        mock_logger.error.assert_called_with("Bot error: Polling failed")
+        self.mock_logger.error.assert_called_with("Bot error: Polling failed")
     
-    @patch('bot.logger')
-    @patch('bot.Application')
-    @patch('bot.BOT_TOKEN', 'test_token')
-    def test_main_error_handler_registration(self, mock_application: Mock, mock_logger: Mock) -> None:
+    def test_main_error_handler_registration(self) -> None:
         """Тест регистрации обработчика ошибок"""
-        mock_builder = Mock()
-        mock_application.builder.return_value = mock_builder
-        mock_app_instance = Mock()
-        mock_builder.token.return_value = mock_builder
-        mock_builder.build.return_value = mock_app_instance
-        
-        # Мокаем run_polling чтобы он сразу завершался
-        mock_app_instance.run_polling.return_value = None
-        
-        from bot import main
-        
         with patch('bot.error_handler') as mock_error_handler:
             # Вызываем функцию
             main()
             
             # Проверяем что обработчик ошибок был зарегистрирован
-            mock_app_instance.add_error_handler.assert_called_once_with(mock_error_handler)
-    
-    @patch('bot.logger')
-    @patch('bot.Application')
-    @patch('bot.BOT_TOKEN', 'test_token')
-    def test_main_logging_info(self, mock_application: Mock, mock_logger: Mock) -> None:
-        """Тест информационного логирования при запуске"""
-        mock_builder = Mock()
-        mock_application.builder.return_value = mock_builder
-        mock_app_instance = Mock()
-        mock_builder.token.return_value = mock_builder
-        mock_builder.build.return_value = mock_app_instance
-        
-        # Мокаем run_polling чтобы он сразу завершался
-        mock_app_instance.run_polling.return_value = None
-        
-        from bot import main
-        
-        # Вызываем функцию
-        main()
-        
-        # Проверяем что было информационное сообщение о запуске
-        mock_logger.info.assert_called_with("Бот запускается...")
+            self.mock_app_instance.add_error_handler.assert_called_once_with(mock_error_handler)
 
 
 if __name__ == '__main__':
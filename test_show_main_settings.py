@@ -1,124 +1,32 @@
 import unittest
-from unittest.mock import Mock, patch, AsyncMock
-from typing import Dict, Any
-
-import sys
-import os
-
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from bot import show_main_settings
 from telegram.constants import ParseMode
+from testutils import DEFAULT_SETTINGS, PatchedDbTestCase, make_env
+
 
+# Разделы, которые должны быть на экране основных настроек при любых значениях
+_EXPECTED_SECTIONS = ("Основные настройки", "Статус бота", "Мин. возраст аккаунта")
+_EXPECTED_CALLBACKS = frozenset({
+    "toggle_enable", "age_settings", "toggle_service", "toggle_flood",
+    "captcha_settings", "warnings_settings", "main_menu",
+})
 
-class TestShowMainSettings(unittest.IsolatedAsyncioTestCase):
+
+class TestShowMainSettings(PatchedDbTestCase):
     """Тесты для функции show_main_settings"""
     
     async def asyncSetUp(self) -> None:
         """Настройка перед каждым тестом"""
-        self.update = Mock()
-        self.context = Mock()
-        self.context.bot = Mock()
-        self.context.user_data = {}
-        
-        # Мокаем базовые объекты Telegram
-        self.user = Mock()
-        self.user.id = 12345
-        self.user.first_name = "TestUser"
-        
-        self.chat = Mock()
-        self.chat.id = 67890
-        self.chat.type = "group"
-        self.chat.title = "Test Group"
-        
-        self.message = AsyncMock()
-        self.message.chat = self.chat
-        self.message.from_user = self.user
-        
-        self.update.effective_user = self.user
-        self.update.effective_chat = self.chat
-        self.update.message = self.message
-        
-        # Мокаем асинхронные методы
-        self.context.bot.send_message = AsyncMock()
-        self.context.bot.edit_message_text = AsyncMock()
-        self.context.bot.get_chat_member = AsyncMock()
-
-    @patch('bot.db')
-    async def test_show_main_settings_with_message_id(self, mock_db: Mock) -> None:
-        """Тест показа основных настроек с message_id"""
-        mock_settings: Dict[str, Any] = {
-            'enabled': True,
-            'welcome_message': 'Test welcome',
-            'min_account_age_days': 7,
-            'min_join_date_days': 0,
-            'restrict_new_users': True,
-            'delete_service_messages': True,
-            'max_warnings': 5,
-            'anti_flood_enabled': False
-        }
-        mock_db.get_chat_settings.return_value = mock_settings
-        
-        await show_main_settings(self.update, self.context, 67890, 111)
-        
-        # Проверяем что edit_message_text был вызван с правильными параметрами
-        self.context.bot.edit_message_text.assert_called_once()
-        
-        # Получаем аргументы вызова
-        call_args = self.context.bot.edit_message_text.call_args
-        self.assertIsNotNone(call_args)
-        
-        # Проверяем аргументы
-        kwargs = call_args[1]  # keyword arguments
-        self.assertEqual(kwargs['chat_id'], 67890)
-        self.assertEqual(kwargs['message_id'], 111)
-        self.assertIn("⚙️ <b>Основные настройки</b>", kwargs['text'])
-        self.assertIn("Статус бота: <b>ВКЛЮЧЕН</b>", kwargs['text'])
-        self.assertIn("Мин. возраст аккаунта: <b>7 дн.</b>", kwargs['text'])
-        self.assertIn("Удаление сообщений: <b>ВКЛ</b>", kwargs['text'])
-        self.assertIn("Анти-флуд: <b>ВЫКЛ</b>", kwargs['text'])
-        self.assertIn("Макс. предупреждений: <b>5</b>", kwargs['text'])
-        self.assertIn("Ограничения новых: <b>ВКЛ</b>", kwargs['text'])
-
-    @patch('bot.db')
-    async def test_show_main_settings_without_message_id(self, mock_db: Mock) -> None:
-        """Тест показа основных настроек без message_id"""
-        mock_settings: Dict[str, Any] = {
-            'enabled': False,
-            'welcome_message': 'Test welcome',
-            'min_account_age_days': 1,
-            'min_join_date_days': 0,
-            'restrict_new_users': False,
-            'delete_service_messages': False,
-            'max_warnings': 3,
-            'anti_flood_enabled': True
-        }
-        mock_db.get_chat_settings.return_value = mock_settings
-        
-        await show_main_settings(self.update, self.context, 67890)
-        
-        # Проверяем что send_message был вызван с правильными параметрами
-        self.context.bot.send_message.assert_called_once()
-        
-        # Получаем аргументы вызова
-        call_args = self.context.bot.send_message.call_args
-        self.assertIsNotNone(call_args)
-        
-        # Проверяем аргументы
-        kwargs = call_args[1]  # keyword arguments
-        self.assertEqual(kwargs['chat_id'], 67890)
-        self.assertIn("⚙️ <b>Основные настройки</b>", kwargs['text'])
-        self.assertIn("Статус бота: <b>ВЫКЛЮЧЕН</b>", kwargs['text'])
-        self.assertIn("Мин. возраст аккаунта: <b>1 дн.</b>", kwargs['text'])
-        self.assertIn("Удаление сообщений: <b>ВЫКЛ</b>", kwargs['text'])
-        self.assertIn("Анти-флуд: <b>ВКЛ</b>", kwargs['text'])
-        self.assertIn("Макс. предупреждений: <b>3</b>", kwargs['text'])
-        self.assertIn("Ограничения новых: <b>ВЫКЛ</b>", kwargs['text'])
+        env = make_env("group", "Test Group")
+        # Вызов командой, а не кнопкой
+        env.update.callback_query = None
+        self.update = env.update
+        self.context = env.context
 
-    @patch('bot.db')
-    async def test_show_main_settings_no_settings(self, mock_db: Mock) -> None:
+    async def test_show_main_settings_no_settings(self) -> None:
         """Тест показа основных настроек когда настройки не найдены"""
-        mock_db.get_chat_settings.return_value = None
+        self.mock_db.get_chat_settings.return_value = None
         
         await show_main_settings(self.update, self.context, 67890, 111)
         
@@ -126,30 +34,16 @@ class TestShowMainSettings(unittest.IsolatedAsyncioTestCase):
         self.context.bot.edit_message_text.assert_not_called()
         self.context.bot.send_message.assert_not_called()
 
-    @patch('bot.db')
-    async def test_show_main_settings_keyboard_structure(self, mock_db: Mock) -> None:
+    async def test_show_main_settings_keyboard_structure(self) -> None:
         """Тест структуры клавиатуры основных настроек"""
-        mock_settings: Dict[str, Any] = {
-            'enabled': True,
-            'welcome_message': 'Test',
-            'min_account_age_days': 3,
-            'min_join_date_days': 0,
-            'restrict_new_users': True,
-            'delete_service_messages': True,
-            'max_warnings': 3,
-            'anti_flood_enabled': True
-        }
-        mock_db.get_chat_settings.return_value = mock_settings
+        self.mock_db.get_chat_settings.return_value = {**DEFAULT_SETTINGS, 'min_account_age_days': 3}
 
         await show_main_settings(self.update, self.context, 67890)
 
         # Проверяем структуру клавиатуры
         self.context.bot.send_message.assert_called_once()
 
-        call_args = self.context.bot.send_message.call_args
-        self.assertIsNotNone(call_args)
-
-        kwargs = call_args[1]
+        kwargs = self.context.bot.send_message.call_args.kwargs
         reply_markup = kwargs['reply_markup']
 
         # Проверяем что клавиатура создана
@@ -157,117 +51,112 @@ class TestShowMainSettings(unittest.IsolatedAsyncioTestCase):
 
         # Проверяем что текст сообщения содержит ожидаемую информацию
         text = kwargs['text']
-        self.assertIn("Основные настройки", text)
-        self.assertIn("Статус бота", text)
-        self.assertIn("Мин. возраст аккаунта", text)
+        missing = [fragment for fragment in _EXPECTED_SECTIONS if fragment not in text]
+        self.assertFalse(missing, f"Missing substrings: {missing}")
 
-        # Вместо проверки callback_data в тексте, проверяем что сообщение было отправлено
-        # с клавиатурой (косвенная проверка)
-        self.assertIsNotNone(reply_markup.inline_keyboard)
-        self.assertGreater(len(reply_markup.inline_keyboard), 0)
+        # Собираем callback_data всех кнопок за один проход и сверяем с ожидаемым набором
+        buttons = {btn.callback_data for row in reply_markup.inline_keyboard for btn in row}
+        missing = _EXPECTED_CALLBACKS - buttons
+        self.assertFalse(missing, f"Missing callbacks: {missing}")
     
-    @patch('bot.db')
-    async def test_show_main_settings_different_states(self, mock_db: Mock) -> None:
-        """Тест показа основных настроек с разными состояниями параметров"""
-        # Используем кортежи вместо сложных типов
+    async def test_show_main_settings_matrix(self) -> None:
+        """Тест текста, получателя и parse_mode основных настроек в разных состояниях"""
+        # (название, настройки, message_id, ожидаемые фрагменты текста)
         test_cases = [
+            (
+                'С message_id',
+                {**DEFAULT_SETTINGS,
+                 'welcome_message': 'Test welcome', 'min_account_age_days': 7,
+                 'max_warnings': 5, 'anti_flood_enabled': False},
+                111,
+                (
+                    "⚙️ <b>Основные настройки</b>",
+                    "Статус бота: <b>ВКЛЮЧЕН</b>",
+                    "Мин. возраст аккаунта: <b>7 дн.</b>",
+                    "Удаление сообщений: <b>ВКЛ</b>",
+                    "Анти-флуд: <b>ВЫКЛ</b>",
+                    "Макс. предупреждений: <b>5</b>",
+                    "Капча для новых: <b>ВЫКЛ</b>"
+                )
+            ),
+            (
+                'Без message_id',
+                {**DEFAULT_SETTINGS,
+                 'enabled': False, 'welcome_message': 'Test welcome',
+                 'restrict_new_users': False, 'delete_service_messages': False},
+                None,
+                (
+                    "⚙️ <b>Основные настройки</b>",
+                    "Статус бота: <b>ВЫКЛЮЧЕН</b>",
+                    "Мин. возраст аккаунта: <b>1 дн.</b>",
+                    "Удаление сообщений: <b>ВЫКЛ</b>",
+                    "Анти-флуд: <b>ВКЛ</b>",
+                    "Макс. предупреждений: <b>3</b>",
+                    "Капча для новых: <b>ВЫКЛ</b>"
+                )
+            ),
             (
                 'Все включено',
-                {
-                    'enabled': True,
-                    'min_account_age_days': 0,
-                    'delete_service_messages': False,
-                    'anti_flood_enabled': True,
-                    'max_warnings': 10,
-                    'restrict_new_users': False
-                },
-                [
+                {**DEFAULT_SETTINGS,
+                 'min_account_age_days': 0, 'restrict_new_users': False,
+                 'delete_service_messages': False, 'max_warnings': 10, 'captcha_enabled': True},
+                None,
+                (
                     "Статус бота: <b>ВКЛЮЧЕН</b>",
                     "Мин. возраст аккаунта: <b>0 дн.</b>",
                     "Удаление сообщений: <b>ВЫКЛ</b>",
                     "Анти-флуд: <b>ВКЛ</b>",
                     "Макс. предупреждений: <b>10</b>",
-                    "Ограничения новых: <b>ВЫКЛ</b>"
-                ]
+                    "Капча для новых: <b>ВКЛ</b>"
+                )
             ),
             (
                 'Все выключено',
-                {
-                    'enabled': False,
-                    'min_account_age_days': 30,
-                    'delete_service_messages': True,
-                    'anti_flood_enabled': False,
-                    'max_warnings': 1,
-                    'restrict_new_users': True
-                },
-                [
+                {**DEFAULT_SETTINGS,
+                 'enabled': False, 'min_account_age_days': 30,
+                 'max_warnings': 1, 'anti_flood_enabled': False},
+                None,
+                (
                     "Статус бота: <b>ВЫКЛЮЧЕН</b>",
                     "Мин. возраст аккаунта: <b>30 дн.</b>",
                     "Удаление сообщений: <b>ВКЛ</b>",
                     "Анти-флуд: <b>ВЫКЛ</b>",
                     "Макс. предупреждений: <b>1</b>",
-                    "Ограничения новых: <b>ВКЛ</b>"
-                ]
+                    "Капча для новых: <b>ВЫКЛ</b>"
+                )
+            ),
+            (
+                'parse_mode',
+                {**DEFAULT_SETTINGS},
+                111,
+                ()
             )
         ]
 
-        for test_name, settings, expected_texts in test_cases:
+        for test_name, settings, message_id, expected_texts in test_cases:
             with self.subTest(test_name):
-                mock_db.get_chat_settings.return_value = {
-                    'enabled': settings['enabled'],
-                    'welcome_message': 'Test',
-                    'min_account_age_days': settings['min_account_age_days'],
-                    'min_join_date_days': 0,
-                    'restrict_new_users': settings['restrict_new_users'],
-                    'delete_service_messages': settings['delete_service_messages'],
-                    'max_warnings': settings['max_warnings'],
-                    'anti_flood_enabled': settings['anti_flood_enabled']
-                }
+                self.mock_db.get_chat_settings.return_value = settings
 
-                # Сбрасываем моки перед каждым тестом
+                # Сбрасываем моки перед каждым случаем
                 self.context.bot.send_message.reset_mock()
+                self.context.bot.edit_message_text.reset_mock()
 
-                await show_main_settings(self.update, self.context, 67890)
+                await show_main_settings(self.update, self.context, 67890, message_id)
 
-                # Проверяем вызов
-                self.context.bot.send_message.assert_called_once()
+                # С message_id сообщение редактируется, без него - отправляется новое
+                sender = self.context.bot.edit_message_text if message_id else self.context.bot.send_message
+                sender.assert_called_once()
 
-                # Проверяем текст
-                call_args = self.context.bot.send_message.call_args
-                self.assertIsNotNone(call_args)
+                kwargs = sender.call_args.kwargs
+                self.assertEqual(kwargs['chat_id'], 67890)
+                if message_id:
+                    self.assertEqual(kwargs['message_id'], message_id)
+                self.assertEqual(kwargs['parse_mode'], ParseMode.HTML)
 
-                kwargs = call_args[1]
+                # Одна проверка на все фрагменты: в сообщении об ошибке сразу видны все недостающие
                 text = kwargs['text']
-
-                for expected_text in expected_texts:
-                    self.assertIn(expected_text, text)
-
-    @patch('bot.db')
-    async def test_show_main_settings_parse_mode(self, mock_db: Mock) -> None:
-        """Тест что сообщение отправляется с правильным parse_mode"""
-        mock_settings: Dict[str, Any] = {
-            'enabled': True,
-            'welcome_message': 'Test',
-            'min_account_age_days': 1,
-            'min_join_date_days': 0,
-            'restrict_new_users': True,
-            'delete_service_messages': True,
-            'max_warnings': 3,
-            'anti_flood_enabled': True
-        }
-        mock_db.get_chat_settings.return_value = mock_settings
-        
-        await show_main_settings(self.update, self.context, 67890, 111)
-        
-        # Проверяем что parse_mode установлен в HTML
-        self.context.bot.edit_message_text.assert_called_once()
-        
-        call_args = self.context.bot.edit_message_text.call_args
-        self.assertIsNotNone(call_args)
-        
-        kwargs = call_args[1]
-        self.assertEqual(kwargs['parse_mode'], ParseMode.HTML)
-
+                missing = [fragment for fragment in expected_texts if fragment not in text]
+                self.assertFalse(missing, f"Missing substrings: {missing}")
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
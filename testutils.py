@@ -0,0 +1,114 @@
+"""Общие заготовки для тестов: настройки чата по умолчанию, моки Telegram-объектов, общий event loop и патч bot.db"""
+import asyncio
+import unittest
+from types import MappingProxyType, SimpleNamespace
+from typing import Any, Mapping, Optional
+from unittest.mock import AsyncMock, Mock, patch
+
+from telegram import Bot, Chat, Message, Update, User
+
+
+# Настройки чата по умолчанию; только для чтения, варианты собираются через {**DEFAULT_SETTINGS, ...},
+# изменяемые копии - через dict(DEFAULT_SETTINGS)
+DEFAULT_SETTINGS: Mapping[str, Any] = MappingProxyType({
+    'enabled': True,
+    'welcome_message': 'Test welcome message',
+    'min_account_age_days': 1,
+    'min_join_date_days': 0,
+    'restrict_new_users': True,
+    'delete_service_messages': True,
+    'max_warnings': 3,
+    'anti_flood_enabled': True
+})
+
+
+def make_env(chat_type: str = "private", chat_title: str = "Test Chat") -> SimpleNamespace:
+    """Моки Telegram-объектов для одного теста: update, context, user, chat, message"""
+    # spec: атрибуты, которых нет у объектов PTB, не создаются на лету, а сразу дают AttributeError
+    user = Mock(spec=User)
+    user.id = 12345
+    user.first_name = "TestUser"
+
+    chat = Mock(spec=Chat)
+    chat.id = 67890
+    chat.type = chat_type
+    chat.title = chat_title
+
+    message = AsyncMock(spec=Message)  # Используем AsyncMock для сообщений
+    message.chat = chat
+    message.from_user = user
+
+    update = Mock(spec=Update)
+    update.effective_user = user
+    update.effective_chat = chat
+    update.message = message
+
+    context = Mock()
+    context.user_data = {}
+    # Методы-корутины Bot (send_message, ban_chat_member, ...) создаются из spec как AsyncMock
+    context.bot = AsyncMock(spec=Bot)
+
+    return SimpleNamespace(update=update, context=context, user=user, chat=chat, message=message)
+
+
+class SharedLoopTestCase(unittest.IsolatedAsyncioTestCase):
+    """IsolatedAsyncioTestCase с одним event loop на класс вместо нового loop на каждый тест
+
+    Переопределяет внутренние _setupAsyncioRunner/_tearDownAsyncioRunner: при изменении
+    IsolatedAsyncioTestCase в CPython править нужно только здесь. Подклассы, которые
+    переопределяют tearDownClass, должны вызывать super().tearDownClass().
+    """
+
+    _shared_runner: Optional[asyncio.Runner] = None
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Закрытие общего event loop класса"""
+        runner = cls.__dict__.get('_shared_runner')
+        if runner is not None:
+            runner.close()
+            cls._shared_runner = None
+        super().tearDownClass()
+
+    def _setupAsyncioRunner(self) -> None:
+        """Loop создается при первом тесте класса и переиспользуется остальными"""
+        cls = type(self)
+        # Проверка по __dict__: у каждого класса свой loop, унаследованный от родителя не используется
+        if cls.__dict__.get('_shared_runner') is None:
+            cls._shared_runner = asyncio.Runner(debug=True)
+        self._asyncioRunner = cls._shared_runner
+
+    def _tearDownAsyncioRunner(self) -> None:
+        """Общий loop не закрывается после теста: это делает tearDownClass"""
+
+
+class PatchedDbTestCase(SharedLoopTestCase):
+    """Тесты обработчиков: один патч bot.db на класс, настройки по умолчанию перед каждым тестом"""
+
+    mock_db: Mock
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Один патч bot.db на весь класс; между тестами мок только сбрасывается"""
+        super().setUpClass()
+        cls._db_patcher = patch('bot.db')
+        cls.mock_db = cls._db_patcher.start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Снятие патча bot.db и закрытие общего event loop"""
+        cls._db_patcher.stop()
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        """Сброс мока базы данных перед каждым тестом"""
+        self._reset_db()
+
+    def _reset_db(self) -> Mock:
+        """Сброс мока базы данных к настройкам по умолчанию"""
+        self.mock_db.reset_mock(return_value=True, side_effect=True)
+        # После сброса return_value магический __contains__ возвращает истину: задаем множество явно
+        self.mock_db.disabled_chats = set()
+        # Копия: обработчики (enable/disable, пресеты) меняют полученные настройки
+        self.mock_db.get_chat_settings.return_value = dict(DEFAULT_SETTINGS)
+        return self.mock_db